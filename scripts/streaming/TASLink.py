@@ -1,13 +1,28 @@
+import bisect
 import os
 import serial
 from serial import SerialException
 import sys
 import cmd
+import collections
+import signal
 import threading
-import yaml
+import Queue
 #import math
 import time
 
+import calibrate
+import control
+import frames
+import instrument
+import manifest
+import metrics
+import movies
+import protocol
+import recorder
+import runcache
+from clock import monotonic, sleepUntil
+
 import rlcompleter, readline  # to add support for tab completion of commands
 import glob
 
@@ -30,11 +45,22 @@ CONTROLLER_MULTITAP = 2  #: multitap (Ports 1 and 2 only) [snes only]
 CONTROLLER_FOUR_SCORE = 3  #: four-score [nes-only peripheral that we don't do anything with]
 
 baud = 2000000
+readTimeout = 0.1  # longest the serial loop blocks waiting on the board before checking on the CLI thread
+
+START_DELAY = 1.0  # seconds from a start command to the consoles starting, unless it says otherwise
+START_HOLD = 0.1  # seconds the consoles are held in reset before they start, unless it says otherwise
+START_LEAD = 0.25  # seconds before a start that the serial thread takes over timing it, covers readTimeout
+START_LATCH_TIMEOUT = 2.0  # seconds to wait for every started run's first latch
 
-prebuffer = 60
+prebuffer = 60  # default number of frames to keep buffered on TASLink for each run
+maxWriteSize = 0  # largest single serial write in bytes, 0 for no limit
+useRunCache = int(os.environ.get('TASLINK_CACHE', 1))  # keep encoded runs on disk so reloading them is instant
 ser = None
 
-TASLINK_CONNECTED = 0  # set to 0 for development without TASLink plugged in, set to 1 for actual testing
+recordFile = os.environ.get('TASLINK_RECORD')  # log everything that crosses the serial port here, see recorder.py
+metricsAddress = os.environ.get('TASLINK_METRICS')  # [host:]port to serve Prometheus metrics on, see metrics.py
+metricsFile = os.environ.get('TASLINK_METRICS_FILE')  # file to keep Prometheus metrics in, see metrics.py
+TASLINK_CONNECTED = int(os.environ.get('TASLINK_CONNECTED', 0))  # set to 0 for development without TASLink plugged in, set to 1 for actual testing
 
 consolePorts = [2, 0, 0, 0, 0]  # 1 when in use, 0 when available. 2 is used to waste cell 0
 consoleLanes = [2, 0, 0, 0, 0, 0, 0, 0, 0]  # 1 when in use, 0 when available. 2 is used to waste cell 0
@@ -42,15 +68,40 @@ lanes = [[-1], [1, 2, 5, 6], [3, 4, 7, 8], [5, 6], [7, 8]]
 MASKS = 'ABCD'
 masksInUse = [0, 0, 0, 0]
 tasRuns = []
-inputBuffers = []
+frameSources = []
 customCommands = []
 isRunModified = [] # TODO: finish implementing this
 frameCounts = [0, 0, 0, 0]
+fifoLevels = [0, 0, 0, 0]  # estimated frames sitting in each run's lanes: frames sent minus latches received
+underrunCounts = [0, 0, 0, 0]
+latchCounts = [0, 0, 0, 0]  # latches each run has received
+framesSentCounts = [0, 0, 0, 0]  # frames each run has sent, seeks and resets included
+bytesWritten = 0
+writeCount = 0
+portLatchCounts = [0, 0, 0, 0, 0]  # latch bytes received for each port, cell 0 unused, counted by demuxLatches
+# only kept while metrics are exported, see recordLoop
+metricsEnabled = False
+loopCounts = [0] * (len(metrics.LOOP_BUCKETS) + 1)  # serial loop iterations by how long they took, see metrics.py
+loopSeconds = 0.0
+latencyRings = None  # one instrument.SampleRing per run slot while timing is turned on, see the latency command
+startWatch = None  # run index -> time of its first latch (None until it comes) after a scheduled start, see startRuns
+
+# Everything above belongs to the serial thread once it's streaming. The CLI hands it anything that changes run state
+# or talks to TASLink through commandQueue, and it gets applied between latch batches. See runInLoop.
+serialThread = threading.current_thread()
+commandQueue = Queue.Queue()
+serialStopped = False
 
 selected_run = -1
 
 # For all x in [0,4), tasRuns[x] should always correspond to have customCommands[x].
 # Each tasRuns[x] listens for latch on the min of of its ports. Each run has progressed up to frame frameCounts[x].
+# Each run's lanes are estimated to hold fifoLevels[x] frames, and get topped back up to the run's prebuffer on latch.
+
+LATCH_BYTES = 'fghi'  # what the board sends when the event on port 1-4 fires
+latchDispatch = [None] * 256  # response byte -> index of the run listening for it, rebuilt whenever runs change
+unknownResponses = collections.deque(maxlen=64)  # (time, byte) of anything from the board we couldn't dispatch
+unknownResponseCount = 0
 
 def readint(question):
     num = -1
@@ -91,42 +142,589 @@ def freeMask(letter):
     return True
 
 
-def load(filename):
+def runInLoop(func, *args):
+    # calls func on the serial thread at the next safe point between latch batches, waits for it, and returns what it
+    # returned. Called from the serial thread itself (or once it's gone) it just calls func.
+    if threading.current_thread() is serialThread or serialStopped:
+        return func(*args)
+    done = threading.Event()
+    result = []
+    commandQueue.put((func, args, done, result))
+    while not done.wait(readTimeout):
+        if serialStopped:  # it went away without getting to us
+            applyCommands()
+    if len(result) == 3:
+        raise result[0], result[1], result[2]
+    return result[0]
+
+
+def applyCommands(timeout=0):
+    # runs whatever the CLI has queued up, waiting up to timeout for the first one
+    try:
+        func, args, done, result = commandQueue.get(timeout > 0, timeout)
+        while True:
+            try:
+                result.append(func(*args))
+            except Exception:
+                result.extend(sys.exc_info())  # handed back to the CLI thread along with the traceback
+            done.set()
+            func, args, done, result = commandQueue.get_nowait()
+    except Queue.Empty:
+        pass
+
+
+def addRun(run, modified, customCommand, frameSource):
+    # applied on the serial thread, with what prepareRun got ready. Gives the custom command back if the run can't be
+    # added
     global selected_run
 
-    with open(filename, 'r') as f:
-        run = yaml.load(f)
     # check for port conflicts
     if not all(isConsolePortAvailable(port, run.controllerType) for port in run.portsList):
-        print("ERROR: Requested ports already in use!")
+        freeMask(customCommand)
         return False
 
+    try:
+        setupCommunication(run, customCommand, frameSource)
+    except Exception:
+        # nothing of a half set up run stays claimed
+        for port in run.portsList:
+            releaseConsolePort(port, run.controllerType)
+        freeMask(customCommand)
+        raise
     # tried switching these two to eliminate the elusive runtime error
-    setupCommunication(run)
     tasRuns.append(run)
-    isRunModified.append(False)
+    isRunModified.append(modified)
+    rebuildLatchDispatch()
 
     selected_run = len(tasRuns) - 1
 
-    send_frames(selected_run, prebuffer)
+    write_data(refill(selected_run))
+    return True
+
 
+def load(filename):
+    # raises ValueError with why the run couldn't be loaded
+    try:
+        fields, movie = manifest.load(filename)
+    except (IOError, manifest.ManifestError) as e:
+        raise ValueError("could not read run: " + str(e))
+    run = TASRun.fromManifest(fields)
+    # the manifest remembers the movie's hash and where its encoded frames are, if it hasn't changed we can skip
+    # reading it again
+    if manifest.movieUnchanged(run.inputFile, movie):
+        runcache.knownHash(run.inputFile, movie['sha1'])
+        run.cacheEntry = movie['encoded']
+    customCommand, frameSource = prepareRun(run)
+
+    if not runInLoop(addRun, run, False, customCommand, frameSource):
+        raise ValueError("requested ports already in use")
     print("Run has been successfully loaded!")
 
-def send_frames(index, amount):
-    framecount = frameCounts[index]
 
-    if TASLINK_CONNECTED == 1:
+def prepareRun(run):
+    # anything slow about getting a run ready happens here, on the calling thread, rather than on the serial thread.
+    # Returns the custom command it took for the run and the run's frame source, to hand to addRun. Raises ValueError
+    # with what went wrong
+    try:
+        run.getReplayFile()  # converts movies from emulators the first time they're used
+    except (IOError, OSError, movies.MovieError) as e:
+        raise ValueError("could not convert " + run.inputFile + ": " + str(e))
+    # the frames are encoded with the run's custom command, so it's taken now and given back if the run isn't added
+    customCommand = runInLoop(getNextMask)
+    if customCommand == 'Z':
+        raise ValueError("all four custom streams are full")
+    try:
+        frameSource = run.getFrameSource(customCommand)
+    except (IOError, OSError) as e:
+        runInLoop(freeMask, customCommand)
+        raise ValueError("could not read " + run.inputFile + ": " + str(e))
+    return customCommand, frameSource
+
+
+def getPortLanes(tasrun, port):
+    # the lanes the run's controllers on the port are on
+    if tasrun.controllerType == CONTROLLER_NORMAL:
+        limit = 1
+    elif tasrun.controllerType == CONTROLLER_MULTITAP:
+        limit = 4
+    else:  # y-cable
+        limit = 2
+    return lanes[port][:limit]
+
+
+def getLaneMask(tasrun):
+    return protocol.laneMask([lane for port in tasrun.portsList for lane in getPortLanes(tasrun, port)])
+
+
+def writeSetup(data):
+    # a whole setup transaction goes out in one write, so the board gets it in one USB transfer
+    if TASLINK_CONNECTED:
+        ser.write(data)
+    else:
+        print(protocol.describe(data))
+
+
+def resetAll():
+    # applied on the serial thread
+    for index in range(len(frameCounts)):
+        frameCounts[index] = 0
+        fifoLevels[index] = 0
+    # clear everything and re-pre-buffer-! every run in the same write
+    write_data(protocol.CLEAR_ALL + ''.join([refill(index) for index in range(len(tasRuns))]))
+
+
+def resetRun(index):
+    # applied on the serial thread
+    seekRun(index, 0)
+
+
+def seekRun(index, frame):
+    # applied on the serial thread. Frames are slices of the run's store, so jumping anywhere costs the same
+    frameCounts[index] = frame
+    fifoLevels[index] = 0
+    # clear the lanes and re-pre-buffer-! from the new frame in the same write
+    write_data(protocol.clearLanes(getLaneMask(tasRuns[index])) + refill(index))
+
+
+def prepareStart(indexes):
+    # applied on the serial thread. Holds the consoles in reset, and clears and prebuffers every run in indexes (every
+    # run on the board, see startRuns) from frame 0, all in one write. Returns when the consoles were held
+    global startWatch
+    startWatch = None
+    for index in indexes:
+        frameCounts[index] = 0
+        fifoLevels[index] = 0
+    write_data(protocol.HOLD_CONSOLE + protocol.CLEAR_ALL + ''.join([refill(index) for index in indexes]))
+    return monotonic()
+
+
+def releaseAt(indexes, at):
+    # applied on the serial thread, which has nothing else to do while the consoles are held. Releases them at the
+    # monotonic time at and starts watching for each run's first latch. Returns when the write started and ended, and
+    # the dict the first latches go in
+    global startWatch
+    sleepUntil(at)
+    before = monotonic()
+    write_data(protocol.RELEASE_CONSOLE)
+    released = monotonic()
+    startWatch = dict([(index, None) for index in indexes])
+    return before, released, startWatch
+
+
+def watchStart(latchTime, batch):
+    # applied on the serial thread after a latch batch while a start is being watched
+    global startWatch
+    for index in batch:
+        if startWatch.get(index, 0) is None:
+            startWatch[index] = latchTime
+    if None not in startWatch.values():
+        startWatch = None
+
+
+def stopWatchingStart():
+    # applied on the serial thread
+    global startWatch
+    startWatch = None
+
+
+def startRuns(indexes, at, hold, waitForLatches=True):
+    # holds the consoles in reset, prebuffers the runs, and releases the consoles at the monotonic time at, after
+    # holding them for at least hold seconds. Returns a report of how close it came, and with waitForLatches, when
+    # each run's console first latched after the release. The reset pin is shared by every console on the board, so
+    # every run has to start over with them
+    if sorted(indexes) != range(len(tasRuns)):
+        raise ValueError("every console on the board is held in reset together, so all " + str(len(tasRuns)) +
+                         " runs have to start together")
+    if at - monotonic() < hold:
+        raise ValueError("the start is less than the hold time away")
+    held = runInLoop(prepareStart, indexes)
+    sleepUntil(at - START_LEAD)
+    before, released, watch = runInLoop(releaseAt, indexes, at)
+    report = {'target': at, 'released': released, 'late_ms': (released - at) * 1e3,
+              'write_ms': (released - before) * 1e3, 'held_ms': (released - held) * 1e3}
+    if waitForLatches:
+        deadline = released + START_LATCH_TIMEOUT
+        while None in watch.values() and monotonic() < deadline:
+            time.sleep(0.01)
+        runInLoop(stopWatchingStart)
+        firstLatches = dict([(index + 1, (latchTime - released) * 1e3) for index, latchTime in watch.items()
+                             if latchTime is not None])
+        report['first_latch_ms'] = firstLatches
+        report['first_latches'] = dict([(index + 1, latchTime) for index, latchTime in watch.items()
+                                        if latchTime is not None])
+        report['skew_ms'] = max(firstLatches.values()) - min(firstLatches.values()) if firstLatches else None
+    return report
+
+
+def readStart(args):
+    # parses "[run|all] [in <seconds>|at <time>] [hold <ms>]", raises ValueError with what's wrong. Returns the run
+    # indexes, the monotonic time to start at and the hold time in seconds
+    indexes = range(len(tasRuns))
+    delay = START_DELAY
+    at = None
+    hold = START_HOLD
+    if args and args[0] not in ('in', 'at', 'hold'):
+        if args[0].lower() != 'all':
+            try:
+                runID = int(args[0])
+            except ValueError:
+                raise ValueError("invalid run number " + args[0])
+            if not 0 < runID <= len(tasRuns):
+                raise ValueError("invalid run number " + args[0])
+            indexes = [runID - 1]
+        args = args[1:]
+    if len(args) % 2:
+        raise ValueError("expected [run|all] [in <seconds>|at <time>] [hold <ms>]")
+    for name, value in zip(args[0::2], args[1::2]):
         try:
-            ser.write(''.join(inputBuffers[index][framecount:(framecount + amount)]))
-        except IndexError:
-            print("Index error in send_frames. This shouldn't happen.\nDEBUG INFORMATION:")
-            print("Index: "+str(index))
-            print("Amount: "+str(amount))
-            print("len(inputBuffers): "+str(len(inputBuffers)))
+            value = float(value)
+        except ValueError:
+            raise ValueError("invalid " + name + " value " + value)
+        if name == 'in':
+            delay = value
+        elif name == 'at':
+            at = value
+        elif name == 'hold':
+            hold = value / 1000.0
+        else:
+            raise ValueError("unknown option " + name)
+    if hold < 0:
+        raise ValueError("the hold time can't be negative")
+    if at is None:
+        at = monotonic() + max(delay, hold)
+    return indexes, at, hold
+
+
+def formatStart(report):
+    lines = ["Consoles released %.3fms after the target (the write took %.3fms), held in reset for %.1fms." % (
+        report['late_ms'], report['write_ms'], report['held_ms'])]
+    if 'first_latch_ms' in report:
+        for run in sorted(report['first_latch_ms']):
+            lines.append("  run #%d first latched %.3fms after the release" % (run, report['first_latch_ms'][run]))
+        if report['skew_ms'] is not None:
+            lines.append("Skew between consoles: %.3fms" % report['skew_ms'])
+        else:
+            lines.append("No console latched within %gs of the release." % START_LATCH_TIMEOUT)
+    return '\n'.join(lines)
+
+
+def getSeekFrame(index, frame, movieFrame):
+    # the run frame to seek to, or None if it's outside the run. Run frames count the dummy frames like the frame
+    # counts do, movie frames count from the first frame of the movie as an emulator's savestate would
+    if movieFrame:
+        frame += tasRuns[index].dummyFrames
+    if not 0 <= frame <= len(frameSources[index]):
+        return None
+    return frame
+
+
+def removeRun(index):
+    # applied on the serial thread
+    global selected_run
+
+    controllerMask = getLaneMask(tasRuns[index])
+    # free ports
+    for port in tasRuns[index].portsList:
+        releaseConsolePort(port, tasRuns[index].controllerType)
+    # free custom stream and event
+    freeMask(customCommands[index])
+    # remove input and run from lists
+    del frameSources[index]
+    del tasRuns[index]
+    del customCommands[index]
+    del isRunModified[index]
+    rebuildLatchDispatch()
+
+    # reset frame counts, move them accordingly
+    for i in range(index, len(frameCounts) - 1):  # one less than the hardcoded max of array
+        frameCounts[i] = frameCounts[i + 1]
+        fifoLevels[i] = fifoLevels[i + 1]
+        underrunCounts[i] = underrunCounts[i + 1]
+        latchCounts[i] = latchCounts[i + 1]
+        framesSentCounts[i] = framesSentCounts[i + 1]
+    frameCounts[-1] = 0  # max should be 0 no matter what, since we've just removed one and compressed the list
+    fifoLevels[-1] = 0
+    underrunCounts[-1] = 0
+    latchCounts[-1] = 0
+    framesSentCounts[-1] = 0
+    if latencyRings is not None:  # reuse the removed run's ring for the now empty last slot
+        ring = latencyRings.pop(index)
+        ring.clear()
+        latencyRings.append(ring)
+
+    # clear the lanes
+    writeSetup(protocol.clearLanes(controllerMask))
+
+    selected_run = len(tasRuns) - 1 # even if there was only 1 run, it will go to -1, signaling we have no more runs
+
+
+def getOverlayPositions(tasrun, laneNumbers):
+    # offsets into one of the run's frames of the bytes that go to the given lanes, all of them for an empty list.
+    # A frame is the command byte and then each lane's bytes, lowest lane first
+    runLanes = sorted([lane for port in tasrun.portsList for lane in getPortLanes(tasrun, port)])
+    frameBytes = len(tasrun.getGatherMap())
+    width = frameBytes // len(runLanes)
+    if not laneNumbers:
+        return range(1, frameBytes + 1)
+    positions = []
+    for lane in laneNumbers:
+        if lane not in runLanes:
+            return None
+        first = 1 + runLanes.index(lane) * width
+        positions.extend(range(first, first + width))
+    return positions
+
+
+def overlayRun(index, start, encoded, positions):
+    # applied on the serial thread. encoded is frames readOverlay has already encoded for the run, laid over it from
+    # frame start (the next frame to be sent when start is None). Frames already sent to TASLink aren't sent again.
+    # Returns the first frame and the number of frames covered
+    if start is None:
+        start = frameCounts[index]
+    return start, frameSources[index].addOverlay(start, encoded, positions)
+
+
+def readOverlay(index, args):
+    # parses "<frame|next> <file> [lane,lane...]" for a run and encodes the file's frames for it, on the calling thread
+    # so a long file doesn't hold up the serial thread. Raises ValueError with what's wrong
+    tasrun = tasRuns[index]
+    if args[0].lower() == 'next':
+        start = None
     else:
-        print("DATA SENT: ", ''.join(inputBuffers[index][framecount:(framecount + amount)]))
+        try:
+            start = int(args[0])
+        except ValueError:
+            raise ValueError("invalid frame number " + args[0])
+        if not 0 <= start < len(frameSources[index]):
+            raise ValueError("frame " + args[0] + " is outside the run")
+    if not os.path.isfile(args[1]):
+        raise ValueError("file " + args[1] + " does not exist")
+    with open(args[1], 'rb') as f:
+        data = f.read()
+    if len(data) < tasrun.getRawFrameSize():
+        raise ValueError("file " + args[1] + " doesn't hold a whole frame")
+    laneNumbers = []
+    if len(args) > 2:
+        try:
+            laneNumbers = [int(lane) for lane in args[2].split(',')]
+        except ValueError:
+            raise ValueError("invalid lanes " + args[2])
+    positions = getOverlayPositions(tasrun, laneNumbers)
+    if positions is None:
+        raise ValueError("lanes " + args[2] + " aren't all the run's")
+    encoded = str(frames.encodeFrames(data, customCommands[index], tasrun.getGatherMap(), tasrun.getRawFrameSize()))
+    return start, encoded, positions
+
+
+def clearOverlays(index):
+    # applied on the serial thread
+    frameSources[index].removeOverlays()
+
+
+def setDummyFrames(index, count):
+    # applied on the serial thread
+    tasRuns[index].dummyFrames = count
+    # the blank frames are a virtual prefix in front of the movie, so this is just a new length for it
+    frameSources[index].setDummyFrames(count)
+
+def setWindow(index, window):
+    # applied on the serial thread, sets up the run's event again with the new window
+    tasrun = tasRuns[index]
+    tasrun.window = window
+    writeSetup(protocol.eventSetup(min(tasrun.portsList), getLaneMask(tasrun), window))
+
+def rebuildLatchDispatch():
+    global latchDispatch
+    table = [None] * 256
+    for run_index, run in enumerate(tasRuns):
+        port = min(run.portsList)  # the same port we have an event listener on
+        table[ord(LATCH_BYTES[port - 1])] = run_index
+    latchDispatch = table  # swap in the whole table at once, the serial loop may be using the old one
+
+
+def demuxLatches(data):
+    # classify everything the board sent in one pass, returns {run index: latches} and counts the latches per port
+    global unknownResponseCount
+    dispatch = latchDispatch
+    latches = {}
+    for b in data:
+        run_index = dispatch[ord(b)]
+        if run_index is None:
+            unknownResponses.append((time.time(), b))
+            unknownResponseCount += 1
+            port = LATCH_BYTES.find(b) + 1  # a latch from a port no run listens on still counts for the port
+            if port:
+                portLatchCounts[port] += 1
+        else:
+            latches[run_index] = latches.get(run_index, 0) + 1
+    for run_index, count in latches.iteritems():
+        portLatchCounts[min(tasRuns[run_index].portsList)] += count
+    return latches
+
+
+def take_frames(index, amount):
+    # returns the data for a run's next frames and moves its frame count along, without sending anything
+    framecount = frameCounts[index]
+    try:
+        data = frameSources[index].getFrames(framecount, amount)
+        available = len(frameSources[index]) - framecount
+    except IndexError:
+        print("Index error in take_frames. This shouldn't happen.\nDEBUG INFORMATION:")
+        print("Index: "+str(index))
+        print("Amount: "+str(amount))
+        print("len(frameSources): "+str(len(frameSources)))
+        return ""
 
     frameCounts[index] += amount
+    sent = max(0, min(amount, available))  # frames past the end of the run never get sent
+    fifoLevels[index] += sent
+    framesSentCounts[index] += sent
+    if fifoLevels[index] > protocol.FIFO_CAPACITY:
+        print("WARNING: Run #" + str(index + 1) + " overran TASLink's buffer, frames were dropped!")
+        fifoLevels[index] = protocol.FIFO_CAPACITY
+    return data
+
+
+def getPrebuffer(run):
+    return getattr(run, 'prebuffer', prebuffer)  # runs saved before this was a setting use the default
+
+
+def refill(index):
+    # returns the data that tops a run's lanes back up to its prebuffer level
+    amount = getPrebuffer(tasRuns[index]) - fifoLevels[index]
+    if amount <= 0:
+        return ""
+    return take_frames(index, amount)
+
+
+def latched(index, latches):
+    # each latch took one frame out of the run's lanes, returns the data to refill them
+    latchCounts[index] += latches
+    level = fifoLevels[index] - latches
+    if level < 0:
+        level = 0
+        if frameCounts[index] < len(frameSources[index]):  # running dry once the run is over is expected
+            underrunCounts[index] += 1
+            print("WARNING: Run #" + str(index + 1) + " ran out of buffered frames at frame " + str(frameCounts[index]) + "!")
+    fifoLevels[index] = level
+    return refill(index)
+
+
+def write_data(data):
+    # everything due at once goes out as one write, split up only if maxWriteSize asks for it
+    global bytesWritten, writeCount
+    if not data:
+        return
+    bytesWritten += len(data)
+    writeCount += 1
+    if TASLINK_CONNECTED == 1:
+        if 0 < maxWriteSize < len(data):
+            for start in range(0, len(data), maxWriteSize):
+                ser.write(data[start:start + maxWriteSize])
+        else:
+            ser.write(data)
+    else:
+        print("DATA SENT: ", data)
+
+
+def recordLoop(latchTime):
+    # applied on the serial thread at the end of an iteration of the serial loop while metrics are exported
+    global loopSeconds
+    elapsed = monotonic() - latchTime
+    loopCounts[bisect.bisect_left(metrics.LOOP_BUCKETS, elapsed)] += 1
+    loopSeconds += elapsed
+
+
+def metricsSnapshot():
+    # applied on the serial thread, so every run's numbers are from the same moment and a run removed in between can't
+    # mix one run's counts up with another's port
+    runs = [(min(run.portsList), latchCounts[index], framesSentCounts[index], fifoLevels[index], frameCounts[index],
+             len(frameSources[index]), underrunCounts[index]) for index, run in enumerate(tasRuns)]
+    return (runs, unknownResponseCount, bytesWritten, writeCount, list(portLatchCounts), list(loopCounts),
+            loopSeconds)
+
+
+def collectMetrics():
+    # called on an exporter's thread. Runs are labelled by the port they listen on rather than their run number, which
+    # changes when an earlier run is removed
+    runs, unknown, written, writes, portLatches, loops, loopTotal = runInLoop(metricsSnapshot)
+    runSamples = dict([(name, []) for name in ('latches', 'sent', 'fifo', 'frame', 'frames', 'underruns')])
+    for port, latches, sent, fifo, frame, numFrames, underruns in runs:
+        labels = [('port', port)]
+        for name, value in (('latches', latches), ('sent', sent), ('fifo', fifo), ('frame', frame),
+                            ('frames', numFrames), ('underruns', underruns)):
+            runSamples[name].append(('', labels, value))
+    families = [
+        ('taslink_latches_total', 'counter', "Latches received for the run.", runSamples['latches']),
+        ('taslink_frames_sent_total', 'counter', "Frames sent for the run.", runSamples['sent']),
+        ('taslink_fifo_frames', 'gauge', "Frames estimated to be in the run's lanes on TASLink.", runSamples['fifo']),
+        ('taslink_frame', 'gauge', "Next frame of the run to be sent.", runSamples['frame']),
+        ('taslink_run_frames', 'gauge', "Frames in the run, dummy frames included.", runSamples['frames']),
+        ('taslink_underruns_total', 'counter', "Times the run's lanes ran dry.", runSamples['underruns']),
+        ('taslink_unknown_responses_total', 'counter', "Bytes from TASLink that no run was listening for.",
+         [('', [], unknown)]),
+        ('taslink_bytes_written_total', 'counter', "Bytes written to TASLink.", [('', [], written)]),
+        ('taslink_writes_total', 'counter', "Writes to TASLink.", [('', [], writes)]),
+        ('taslink_runs', 'gauge', "Active runs.", [('', [], len(runs))]),
+    ]
+    if TASLINK_CONNECTED:
+        families.append(('taslink_port_latches_total', 'counter', "Latches received from the console port.",
+                         [('', [('port', port)], portLatches[port]) for port in range(1, 5)]))
+        families.append(('taslink_loop_seconds', 'histogram',
+                         "Time from TASLink's bytes arriving to the serial loop being done with them.",
+                         metrics.histogramSamples([], metrics.LOOP_BUCKETS, loops, loopTotal)))
+    return metrics.render(families)
+
+
+def send_frames(index, amount):
+    write_data(take_frames(index, amount))
+
+
+def enableInstrumentation():
+    global latencyRings
+    if latencyRings is None:
+        latencyRings = [instrument.SampleRing() for _ in frameCounts]  # allocated once, up front
+
+
+def disableInstrumentation():
+    global latencyRings
+    latencyRings = None
+
+
+def startCalibration(index):
+    # applied on the serial thread: turn the run's window off and record its latches from a clean slate
+    enableInstrumentation()
+    latencyRings[index].clear()
+    setWindow(index, 0)
+
+
+def finishCalibration(index, window, keepInstrumentation):
+    # applied on the serial thread: put the window back and hand over what was recorded
+    samples = latencyRings[index].ordered() if latencyRings is not None else []
+    if not keepInstrumentation:
+        disableInstrumentation()
+    setWindow(index, window)
+    return samples
+
+
+def calibrationResult(samples, stable=False):
+    analyze = calibrate.analyzeStable if stable else calibrate.analyze
+    return analyze(samples[instrument.LATCH::instrument.NUM_FIELDS], samples[instrument.LATCHES::instrument.NUM_FIELDS])
+
+
+def instrumentedRefill(latchTime, batch):
+    # same as the plain refill in the serial loop, but records when each run latched and when its refill went out
+    data = []
+    sent = []
+    for run_index, latches in batch.iteritems():
+        before = frameCounts[run_index]
+        data.append(latched(run_index, latches))
+        sent.append((run_index, latches, frameCounts[run_index] - before))
+    writeStart = monotonic()
+    write_data(''.join(data))
+    writeEnd = monotonic()
+    for run_index, latches, frameCount in sent:
+        latencyRings[run_index].record(latchTime, latches, writeStart, writeEnd, frameCount)
 
 
 class TASRun(object):
@@ -140,8 +738,10 @@ class TASRun(object):
         self.inputFile = file_name
         self.dummyFrames = dummy_frames
         self.dpcmFix = dpcm_fix
+        self.prebuffer = prebuffer
+        self.cacheEntry = None  # where the run's encoded frames were last cached, if we know
 
-        self.fileExtension = file_name.split(".")[-1].strip()  # pythonic last element of a list/string/array
+        self.fileExtension = movies.replayType(file_name)  # movies from emulators get converted to one of ours
 
         if self.fileExtension == 'r08':
             self.maxControllers = 2
@@ -150,166 +750,107 @@ class TASRun(object):
         else:
             self.maxControllers = 1  # random default, but truly we need to support other formats
 
-    def getInputBuffer(self, customCommand):
-        with open(self.inputFile, 'rb') as myfile:
-            wholefile = myfile.read()
-        count = 0
-        working_string = ""
-        numBytes = int(self.controllerBits / 8)
-        bytesPerFrame = numBytes * self.maxControllers # 1 * 2 = 2 for NES, 2 * 8 = 16 for SNES
-        buffer = [""] * (int(len(wholefile) / bytesPerFrame) + self.dummyFrames)  # create a new empty buffer
-
-        numLanes = self.numControllers
-        # next we take controller type into account
-        if self.controllerType == CONTROLLER_Y or self.controllerType == CONTROLLER_FOUR_SCORE:
-            numLanes *= 2
-        elif self.controllerType == CONTROLLER_MULTITAP:
-            numLanes *= 4
-
-        bytesPerCommand = numLanes * numBytes
-
-        # add the dummy frames
-        for frame in range(self.dummyFrames):
-            working_string = customCommand
-            for bytes in range(bytesPerCommand):
-                working_string += chr(0xFF)
-            buffer[frame] = working_string
-
-        frameno = 0
-        invertedfile = [""] * len(wholefile)
-        for index, b in enumerate(wholefile):
-            invertedfile[index] = chr(~ord(b) & 0xFF)  # flip our 1's and 0's to be hardware compliant; mask just to make sure its a byte
-
-        if self.fileExtension == 'r08':
-            while True:
-                working_string = customCommand
-
-                one_frame = invertedfile[frameno * 2:frameno * 2 + 2]
+    @staticmethod
+    def fromManifest(fields):
+        run = TASRun(fields['numControllers'], fields['portsList'], fields['controllerType'], fields['controllerBits'],
+                     fields['overread'], fields['window'], fields['inputFile'], fields['dummyFrames'],
+                     fields['dpcmFix'])
+        if fields['prebuffer'] is not None:
+            run.prebuffer = fields['prebuffer']
+        return run
+
+    def getManifest(self):
+        # the settings that make up a saved run, see manifest.py
+        return {'numControllers': self.numControllers, 'portsList': self.portsList,
+                'controllerType': self.controllerType, 'controllerBits': self.controllerBits,
+                'overread': self.overread, 'window': self.window, 'inputFile': self.inputFile,
+                'dummyFrames': self.dummyFrames, 'dpcmFix': self.dpcmFix, 'prebuffer': getPrebuffer(self)}
+
+    def getMovieInfo(self, customCommand):
+        # the movie's hash and cache entry, so loading the saved run doesn't have to read the movie again
+        if not useRunCache or not os.path.isfile(self.inputFile):
+            return None
+        encoded = None
+        if self.getRawFrameSize() > 0:
+            encoded = runcache.entryPath(self.getReplayFile(), customCommand, self.getGatherMap(),
+                                         self.getRawFrameSize())
+        return manifest.movieInfo(self.inputFile, runcache.fileHash(self.inputFile), encoded)
 
-                if len(one_frame) != 2:  # fail case
-                    break
+    def getReplayFile(self):
+        # the raw replay to stream, which is the input file unless that's a movie that needed converting
+        return movies.replayFile(self.inputFile)
 
-                working_string += ''.join(one_frame)
-
-                # combine the appropriate parts of working_string
-                command_string = working_string[0]
-                for counter in range(self.numControllers):
-                    if self.controllerType == CONTROLLER_FOUR_SCORE:
-                        pass # what is a four score?  would probably require a new file format in fact....
-                    else: # normal controller
-                        command_string += working_string[counter+1:counter+2]  # math not-so-magic
-                buffer[frameno+self.dummyFrames] = command_string
-                frameno += 1
+    def getRawFrameSize(self):
+        if self.fileExtension == 'r08':
+            return 2
         elif self.fileExtension == 'r16' or self.fileExtension == 'r16m':
-            while True:
-                working_string = customCommand
-
-                one_frame = invertedfile[frameno*16:frameno*16+16]
-
-                if len(one_frame) != 16:  # fail case
-                    break
+            return 16
+        else:
+            return 0
 
-                working_string += ''.join(one_frame)
+    def getGatherMap(self):
+        # offsets into one raw frame of the bytes that get sent to our lanes, in lane order
+        if self.fileExtension == 'r08':
+            if self.controllerType == CONTROLLER_FOUR_SCORE:
+                return []  # what is a four score?  would probably require a new file format in fact....
+            offsets = range(self.numControllers)
+        elif self.fileExtension == 'r16' or self.fileExtension == 'r16m':
+            if self.controllerType == CONTROLLER_Y:
+                width = 4
+            elif self.controllerType == CONTROLLER_MULTITAP:
+                width = 8
+            else:
+                width = 2
+            offsets = [(counter * 8) + x for counter in range(self.numControllers) for x in range(width)]  # math magic
+        else:
+            return []
+        return [offset for offset in offsets if offset < self.getRawFrameSize()]
 
-                # combine the appropriate parts of working_string
-                command_string = working_string[0]
-                for counter in range(self.numControllers):
-                    if self.controllerType == CONTROLLER_Y:
-                        command_string += working_string[(counter * 8) + 1:(counter * 8) + 5]  # math magic
-                    elif self.controllerType == CONTROLLER_MULTITAP:
-                        command_string += working_string[(counter * 8) + 1:(counter * 8) + 9]  # math magic
-                    else:
-                        command_string += working_string[(counter * 8) + 1:(counter * 8) + 3]  # math magic
-                buffer[frameno+self.dummyFrames] = command_string
-                frameno += 1
+    def getFrameSource(self, customCommand):
+        gatherMap = self.getGatherMap()
+        # a blank frame is as long as a movie frame, which is however many bytes the gather map picks out
+        dummyFrame = customCommand + chr(0xFF) * len(gatherMap)
 
-        return buffer
+        encoded = None
+        if useRunCache:
+            encoded = runcache.load(self.getReplayFile(), customCommand, gatherMap, self.getRawFrameSize(),
+                                    self.cacheEntry)
 
+        return frames.FrameSource(self.getReplayFile(), customCommand, gatherMap, self.getRawFrameSize(),
+                                  self.dummyFrames, dummyFrame, encoded)
 
-def setupCommunication(tasrun):
+def setupCommunication(tasrun, customCommand, frameSource):
     print("Now preparing TASLink....")
     # claim the ports / lanes
     for port in tasrun.portsList:
         claimConsolePort(port, tasrun.controllerType)
 
-    # begin serial communication
-    controllers = list('00000000')
+    # begin serial communication, the whole setup goes out as one write
+    setup = []
     # set controller lanes and ports
     for port in tasrun.portsList:
-        # enable the console ports
-        command = "sp"
-        command += str(port)  # should look like 'sp1' now
-        portData = tasrun.controllerType
+        # enable the console ports, the dpcm fix is sent as the clock delay alone in place of the controller type
         if tasrun.dpcmFix:
-            portData = +128
-        if TASLINK_CONNECTED:
-            ser.write(command + chr(portData))
+            setup.append(protocol.portSetup(port, 0, clockDelay=True))
         else:
-            print(command, portData)
-
+            setup.append(protocol.portSetup(port, tasrun.controllerType))
         # enable the controllers lines
-        if tasrun.controllerType == CONTROLLER_NORMAL:
-            limit = 1
-        elif tasrun.controllerType == CONTROLLER_MULTITAP:
-            limit = 4
-        else:
-            limit = 2
-        for counter in range(limit):
-            command = "sc" + str(lanes[port][counter])  # should look like 'sc1' now
-            controllers[8 - lanes[port][counter]] = '1'  # this is used later for the custom stream command
-            # now we need to set the byte data accordingly
-            byte = list('00000000')
-            byte[0] = '1'  # first set it plugged in
-            byte[1] = str(tasrun.overread)  # next set overread value
-            # set controller size
-            if tasrun.controllerBits == 8:
-                pass  # both bytes should be 0, so we're good
-            elif tasrun.controllerBits == 16:
-                byte[7] = '1'
-            elif tasrun.controllerBits == 24:
-                byte[6] = '1'
-            elif tasrun.controllerBits == 32:
-                byte[6] = '1'
-                byte[7] = '1'
-            bytestring = "".join(byte)  # convert binary to string
-            if TASLINK_CONNECTED:
-                ser.write(command + chr(int(bytestring, 2)))  # send the sc command
-            else:
-                print(command, bytestring)
+        for lane in getPortLanes(tasrun, port):
+            setup.append(protocol.controllerSetup(lane, tasrun.controllerBits, tasrun.overread))
 
     # setup custom stream command
-    command = 's'
-    customCommand = getNextMask()
-    customCommands.append(customCommand)
-    if customCommand == 'Z':
-        print("ERROR: all four custom streams are full!")
-        # TODO: handle gracefully
-    controllerMask = "".join(controllers)  # convert binary to string
-    command += customCommand
-    if TASLINK_CONNECTED:
-        ser.write(command + chr(int(controllerMask, 2)))  # send the sA/sB/sC/sD command
-    else:
-        print(command, controllerMask)
-
-    # setup events #s e lane_num byte controllerMask
-    command = 'se' + str(min(tasrun.portsList))
-    # do first byte
-    byte = list(
-        '{0:08b}'.format(int(tasrun.window / 0.25)))  # create padded bytestring, convert to list for manipulation
-    byte[0] = '1'  # enable flag
-    bytestring = "".join(byte)  # turn back into string
-    if TASLINK_CONNECTED:
-        ser.write(command + chr(int(bytestring, 2)) + chr(int(controllerMask, 2)))  # send the sA/sB/sC/sD command
-    else:
-        print(command, bytestring, controllerMask)
+    controllerMask = getLaneMask(tasrun)
+    setup.append(protocol.streamSetup(customCommand, controllerMask))
+
+    # setup events
+    setup.append(protocol.eventSetup(min(tasrun.portsList), controllerMask, tasrun.window))
 
     # finnal, clear lanes and get ready to rock
-    if TASLINK_CONNECTED:
-        ser.write("r" + chr(int(controllerMask, 2)))
-    else:
-        print("r", controllerMask)
+    setup.append(protocol.clearLanes(controllerMask))
+    writeSetup(''.join(setup))
 
-    inputBuffers.append(tasrun.getInputBuffer(customCommand))  # add the input buffer to a global list of input buffers
+    customCommands.append(customCommand)
+    frameSources.append(frameSource)  # add the frame source to a global list of frame sources
 
 
 def isConsolePortAvailable(port, type):
@@ -450,8 +991,12 @@ class CLI(cmd.Cmd):
 
         filename = raw_input("Please enter filename: ")
 
-        with open(filename, 'w') as f:
-            f.write(yaml.dump(tasRuns[runID - 1]))
+        run = tasRuns[runID - 1]
+        try:
+            manifest.save(filename, run.getManifest(), run.getMovieInfo(customCommands[runID - 1]))
+        except (IOError, OSError) as e:
+            print("ERROR: Could not save run: " + str(e))
+            return False
 
         isRunModified[runID - 1] = False
 
@@ -459,17 +1004,47 @@ class CLI(cmd.Cmd):
 
     def do_off(self, data):
         """Turns off the SNES via reset pin, if connected"""
-        ser.write("sd1")
+        runInLoop(write_data, protocol.HOLD_CONSOLE)
 
     def do_on(self, data):
         """Turns on the SNES via reset pin, if connected"""
-        ser.write("sd0")
+        runInLoop(write_data, protocol.RELEASE_CONSOLE)
 
     def do_restart(self, data):
-        """Turns the SNES console off, restarts the current run, and turns the SNES console on"""
-        self.do_off(data)
-        self.do_reset(data)
-        self.do_on(data)
+        """Holds the consoles in reset and restarts every run: restart [all] (a single run only when it's the only one)"""
+        if not tasRuns:
+            print("No currently active runs.")
+            return False
+        if data == "":
+            data = str(selected_run + 1)
+        try:
+            indexes, at, hold = readStart(data.split()[:1])
+        except ValueError as e:
+            print("ERROR: " + str(e) + "!")
+            return False
+        try:
+            startRuns(indexes, monotonic() + max(START_HOLD, START_LEAD), START_HOLD, False)
+        except ValueError as e:
+            print("ERROR: " + str(e) + "!")
+            return False
+        print("Restart complete!")
+
+    def do_start(self, data):
+        """Start every run and console on the board together: start [all] [in <seconds>|at <time>] [hold <ms>]"""
+        if not tasRuns:
+            print("No currently active runs.")
+            return False
+        try:
+            indexes, at, hold = readStart(data.split())
+        except ValueError as e:
+            print("ERROR: " + str(e) + "!")
+            return False
+        try:
+            report = startRuns(indexes, at, hold)
+        except ValueError as e:
+            print("ERROR: " + str(e) + "!")
+            return False
+        print(formatStart(report))
 
     def do_modify_frames(self, data):
         """Modify the initial blank input frames"""
@@ -494,24 +1069,10 @@ class CLI(cmd.Cmd):
         run = tasRuns[index]
         print("The current number of initial blank frames is : " + str(run.dummyFrames))
         frames = readint("How many initial blank frames do you want? ")
-        difference = frames - run.dummyFrames  # positive means we're adding frames, negative means we're removing frames
-        run.dummyFrames = frames
-        # modify input buffer accordingly
-        if difference > 0:
-            working_string = customCommands[index]
-            max = int(run.controllerBits / 8) * run.numControllers  # bytes * number of controllers
-            # next we take controller type into account
-            if run.controllerType == CONTROLLER_Y or run.controllerType == CONTROLLER_FOUR_SCORE:
-                max *= 2
-            elif run.controllerType == CONTROLLER_MULTITAP:
-                max *= 4
-            for bytes in range(max):
-                working_string += chr(0xFF)
-
-            for count in range(difference):
-                inputBuffers[index].insert(0, working_string)  # add the correct number of blank input frames
-        elif difference < 0:  # remove input frames
-            inputBuffers[index] = inputBuffers[index][-difference:]
+        if frames < 0:
+            print("ERROR: Number of blank frames can't be negative!")
+            return False
+        runInLoop(setDummyFrames, index, frames)
 
         isRunModified[index] = True
 
@@ -519,21 +1080,13 @@ class CLI(cmd.Cmd):
 
     def do_reset(self, data):
         """Reset an active run back to frame 0"""
-        global frameCounts
-
         # print options
         if not tasRuns:
             print("No currently active runs.")
             return False
 
         if data.lower() == 'all':
-            if TASLINK_CONNECTED:
-                ser.write("R")
-            else:
-                print("R")
-            frameCounts = [0, 0, 0, 0]
-            for index in range(len(tasRuns)):
-                send_frames(index, prebuffer)  # re-pre-buffer-!
+            runInLoop(resetAll)
             print("Reset command given to all runs!")
             return False
         elif data != "":
@@ -550,35 +1103,70 @@ class CLI(cmd.Cmd):
                 return False
         else:
             runID = selected_run + 1
-        index = runID - 1
-        # get the lane mask
-        controllers = list('00000000')
-        tasrun = tasRuns[index]
-        if tasrun.controllerType == CONTROLLER_NORMAL:
-            limit = 1
-        elif tasrun.controllerType == CONTROLLER_MULTITAP:
-            limit = 4
-        else:
-            limit = 2
-
-        for port in tasrun.portsList:
-            for counter in range(limit):
-                controllers[8 - lanes[port][counter]] = '1'
-
-        controllerMask = "".join(controllers)  # convert binary to string
+        runInLoop(resetRun, runID - 1)
+        print("Reset complete!")
 
-        if TASLINK_CONNECTED:
-            ser.write("r" + chr(int(controllerMask, 2)))  # clear the buffer
-        else:
-            print("r" + controllerMask, 2)  # clear the buffer
+    def do_seek(self, data):
+        """Jump a run to a frame and buffer from there: seek <run> <frame> [movie]"""
+        if not tasRuns:
+            print("No currently active runs.")
+            return False
+        args = data.split()
+        if len(args) not in (2, 3) or (len(args) == 3 and args[2].lower() != 'movie'):
+            print("ERROR: Usage: seek <run> <frame> [movie]")
+            return False
+        try:
+            runID = int(args[0])
+            frame = int(args[1])
+        except ValueError:
+            print("ERROR: Please enter a run number and a frame number!\n")
+            return False
+        if not 0 < runID <= len(tasRuns):
+            print("ERROR: Invalid run number!")
+            return False
+        index = runID - 1
+        target = getSeekFrame(index, frame, len(args) == 3)
+        if target is None:
+            print("ERROR: Run #" + str(runID) + " only has " + str(len(frameSources[index])) + " frames (" +
+                  str(tasRuns[index].dummyFrames) + " of them blank)!")
+            return False
+        runInLoop(seekRun, index, target)
+        print("Run #" + str(runID) + " is now at frame " + str(target) + ".")
 
-        frameCounts[index] = 0
-        send_frames(index, prebuffer)  # re-pre-buffer-!
-        print("Reset complete!")
+    def do_overlay(self, data):
+        """Splice input over part of a run: overlay <run> <frame|next> <file> [lane,lane...], or overlay <run> clear"""
+        if not tasRuns:
+            print("No currently active runs.")
+            return False
+        args = data.split()
+        if len(args) == 2 and args[1].lower() == 'clear':
+            pass
+        elif len(args) not in (3, 4):
+            print("ERROR: Usage: overlay <run> <frame|next> <file> [lane,lane...] or overlay <run> clear")
+            return False
+        try:
+            runID = int(args[0])
+        except ValueError:
+            print("ERROR: Invalid run number!")
+            return False
+        if not 0 < runID <= len(tasRuns):
+            print("ERROR: Invalid run number!")
+            return False
+        index = runID - 1
+        if len(args) == 2:
+            runInLoop(clearOverlays, index)
+            print("Run #" + str(runID) + " is back to its movie.")
+            return False
+        try:
+            start, encoded, positions = readOverlay(index, args[1:])
+        except ValueError as e:
+            print("ERROR: " + str(e) + "!")
+            return False
+        start, count = runInLoop(overlayRun, index, start, encoded, positions)
+        print("Overlaid frames " + str(start) + " to " + str(start + count - 1) + " of run #" + str(runID) + ".")
 
     def do_remove(self, data):
         """Remove one of the current runs."""
-        global selected_run
         # print options
         if not tasRuns:
             print("No currently active runs.")
@@ -596,43 +1184,7 @@ class CLI(cmd.Cmd):
                 return False
         else:
             runID = selected_run + 1
-        index = runID - 1
-        # make the mask
-        controllers = list('00000000')
-        tasrun = tasRuns[index]
-        if tasrun.controllerType == CONTROLLER_NORMAL:
-            limit = 1
-        elif tasrun.controllerType == CONTROLLER_MULTITAP:
-            limit = 4
-        else: # y-cable
-            limit = 2
-        for port in tasrun.portsList:
-            for counter in range(limit):
-                controllers[8 - lanes[port][counter]] = '1'
-        controllerMask = "".join(controllers)  # convert binary to string
-        # free ports
-        for port in tasRuns[index].portsList:
-            releaseConsolePort(port, tasRuns[index].controllerType)
-        # free custom stream and event
-        freeMask(customCommands[index])
-        # remove input and run from lists
-        del inputBuffers[index]
-        del tasRuns[index]
-        del customCommands[index]
-        del isRunModified[index]
-
-        # reset frame counts, move them accordingly
-        for i in range(index, len(frameCounts) - 1):  # one less than the hardcoded max of array
-            frameCounts[i] = frameCounts[i + 1]
-        frameCounts[-1] = 0  # max should be 0 no matter what, since we've just removed one and compressed the list
-
-       # clear the lanes
-        if TASLINK_CONNECTED:
-            ser.write("r" + chr(int(controllerMask, 2)))  # clear the buffer
-        else:
-            print("r" + controllerMask, 2)  # clear the buffer
-
-        selected_run = len(tasRuns) - 1 # even if there was only 1 run, it will go to -1, signaling we have no more runs
+        runInLoop(removeRun, runID - 1)
 
         print("Run has been successfully removed!")
 
@@ -645,7 +1197,10 @@ class CLI(cmd.Cmd):
         if not os.path.isfile(filename):
             print("ERROR: File does not exist!")
             return False
-        load(filename)
+        try:
+            load(filename)
+        except ValueError as e:
+            print("ERROR: " + str(e) + "!")
 
     def do_list(self, data):
         """List all active runs"""
@@ -654,7 +1209,7 @@ class CLI(cmd.Cmd):
             return False
         for index, run in enumerate(tasRuns):
             print("Run #" + str(index + 1) + ": ")
-            print yaml.dump(run)
+            print manifest.dumps(run.getManifest())
         pass
 
     def do_select(self, data):
@@ -791,15 +1346,153 @@ class CLI(cmd.Cmd):
         # create TASRun object and assign it to our global, defined above
         tasrun = TASRun(numControllers, portsList, controllerType, controllerBits, overread, window, fileName, dummyFrames, dpcm_fix)
 
-        setupCommunication(tasrun)
-        tasRuns.append(tasrun)
-        isRunModified.append(True)
+        try:
+            customCommand, frameSource = prepareRun(tasrun)
+        except ValueError as e:
+            print("ERROR: " + str(e) + "!")
+            return False
 
-        selected_run = len(tasRuns) - 1
+        if runInLoop(addRun, tasrun, True, customCommand, frameSource):
+            print("Run is ready to go!")
+        else:
+            print("ERROR: Requested ports already in use!")
 
-        send_frames(selected_run, prebuffer)
+    def do_prebuffer(self, data):
+        """Show buffer levels, or set how many frames to keep buffered for a run: prebuffer [run] <frames>"""
+        if not tasRuns:
+            print("No currently active runs.")
+            return False
+        args = data.split()
+        if not args:
+            for index, run in enumerate(tasRuns):
+                print("Run #" + str(index + 1) + ": ~" + str(fifoLevels[index]) + " of " + str(getPrebuffer(run)) +
+                      " frames buffered, " + str(underrunCounts[index]) + " underruns")
+            return False
+        try:
+            args = [int(x) for x in args]
+        except ValueError:
+            print("ERROR: Please enter integers!")
+            return False
+        if len(args) == 1:
+            runID = selected_run + 1
+            amount = args[0]
+        else:
+            runID, amount = args[0], args[1]
+        if not 0 < runID <= len(tasRuns):
+            print("ERROR: Invalid run number!")
+            return False
+        if not 1 <= amount <= protocol.FIFO_CAPACITY:
+            print("ERROR: Prebuffer must be between 1 and " + str(protocol.FIFO_CAPACITY) + " frames!")
+            return False
+        tasRuns[runID - 1].prebuffer = amount
+        isRunModified[runID - 1] = True
+        print("Run #" + str(runID) + " will keep " + str(amount) + " frames buffered.")
+
+    def do_diag(self, data):
+        """Show responses from TASLink that didn't match any run"""
+        print("Unknown responses received: " + str(unknownResponseCount))
+        for when, b in unknownResponses:
+            print(time.strftime("%H:%M:%S", time.localtime(when)) + "  0x%02X %r" % (ord(b), b))
+
+    def do_latency(self, data):
+        """Time latches and refills: latency [on|off|clear|dump <file>], shows the stats with no arguments"""
+        global latencyRings
+        args = data.split()
+        if args and args[0] == 'on':
+            runInLoop(enableInstrumentation)
+            print("Latency instrumentation is on.")
+        elif args and args[0] == 'off':
+            runInLoop(disableInstrumentation)
+            print("Latency instrumentation is off.")
+        elif latencyRings is None:
+            print("Latency instrumentation is off, turn it on with: latency on")
+        elif args and args[0] == 'clear':
+            runInLoop(lambda: [ring.clear() for ring in latencyRings])
+        elif args and args[0] == 'dump':
+            if len(args) < 2:
+                print("ERROR: Please enter a file to dump to!")
+                return False
+            try:
+                instrument.dump([(index + 1, latencyRings[index]) for index in range(len(tasRuns))], args[1])
+            except (IOError, OSError) as e:
+                print("ERROR: Could not write samples: " + str(e))
+                return False
+            print("Samples written to " + args[1])
+        elif args:
+            print("ERROR: Unknown option " + args[0])
+        else:
+            for index, run in enumerate(tasRuns):
+                stats = instrument.summarize(latencyRings[index])
+                print("Run #" + str(index + 1) + " (port " + str(min(run.portsList)) + "): " + str(stats['latches']) +
+                      " latches in " + str(stats['samples']) + " reads")
+                print("  latch to write: p50 %.3fms  p99 %.3fms  max %.3fms" % (stats['p50'], stats['p99'], stats['max']))
+                print("  latch interval: %.3fms  jitter %.3fms  min %.3fms  max %.3fms" %
+                      (stats['interval'], stats['jitter'], stats['interval_min'], stats['interval_max']))
+
+    def do_calibrate(self, data):
+        """Measure a run's latches with the window off and find the window it needs: calibrate [run] [frames] [apply]"""
+        if not tasRuns:
+            print("No currently active runs.")
+            return False
+        args = data.split()
+        apply = 'apply' in args
+        try:
+            args = [int(x) for x in args if x != 'apply']
+        except ValueError:
+            print("ERROR: Please enter integers!")
+            return False
+        runID = args[0] if args else selected_run + 1
+        numFrames = args[1] if len(args) > 1 else 600
+        if not 0 < runID <= len(tasRuns):
+            print("ERROR: Invalid run number!")
+            return False
+        if not 10 <= numFrames <= instrument.DEFAULT_CAPACITY // 4:
+            print("ERROR: Frames must be between 10 and " + str(instrument.DEFAULT_CAPACITY // 4) + "!")
+            return False
+        index = runID - 1
+        run = tasRuns[index]
 
-        print("Run is ready to go!")
+        print("Recording run #" + str(runID) + " on port " + str(min(run.portsList)) + " for " + str(numFrames) +
+              " frames with the window off, play normally...")
+        window = run.window
+        keepInstrumentation = latencyRings is not None
+        runInLoop(startCalibration, index)
+        deadline = time.time() + numFrames / 50.0 * 2 + 10  # plenty of time at PAL speed
+        # every frame is at least one read, so only look closer once there are enough reads. Working the frames out
+        # takes the GIL away from the serial thread, which would show up as jitter in what we're measuring
+        while time.time() < deadline and latencyRings is not None:
+            if latencyRings[index].count >= numFrames:
+                missing = numFrames - calibrationResult(latencyRings[index].ordered())['frames']
+                if missing <= 0:
+                    break
+                time.sleep(missing / 60.0)
+            else:
+                time.sleep(0.25)
+        result = calibrationResult(runInLoop(finishCalibration, index, window, keepInstrumentation), stable=True)
+        print(str(result['latches']) + " latches over " + str(result['frames']) + " frames, " + str(result['clusters']) +
+              " frames latched more than once")
+        print("  frame interval %.3fms  between frames %.3fms (shortest %.3fms)  inside a frame %.3fms (longest %.3fms)" %
+              (result['frame_interval'], result['frame_gap'], result['min_frame_gap'], result['gap'], result['max_gap']))
+        if result['reason'] == 'unresolved gap':
+            print("Every frame's latches came in together, so how far apart they are can't be told. Leaving the " +
+                  "window at " + str(window) + "ms, try a shorter latency timer on the serial port.")
+        elif result['reason'] == 'unstable':
+            print("The two halves of the recording want different windows (%s), leaving it at %sms. Calibrate again "
+                  "over more frames." % (" and ".join([str(half) + "ms" if half is not None else "none"
+                                                      for half in result['halves']]), window))
+        elif result['window'] is None:
+            print("No window merges these latches without merging frames too, leaving it at " + str(window) + "ms.")
+        elif result['window'] == window:
+            print("The current window of " + str(window) + "ms is already the right one.")
+        elif apply:
+            runInLoop(setWindow, index, result['window'])
+            isRunModified[index] = True
+            print("Window set to " + str(result['window']) + "ms (was " + str(window) + "ms).")
+        else:
+            print("Recommended window: " + str(result['window']) + "ms (currently " + str(window) + "ms), " +
+                  "use 'calibrate " + str(runID) + " " + str(numFrames) + " apply' to set it.")
+        if result['latches'] > result['frames']:
+            print("Each of those latches used up a frame, reset the run before playing it.")
 
     def do_EOF(self, line):
         """/wave"""
@@ -808,62 +1501,281 @@ class CLI(cmd.Cmd):
     def postloop(self):
         print
 
+# handlers for requests on the control socket in daemon mode, see control.py
+
+def controlRunIndex(args):
+    # run number from a request, the selected run if there isn't one
+    if not tasRuns:
+        raise control.ControlError("no active runs")
+    if not args:
+        return selected_run
+    try:
+        runID = int(args[0])
+    except ValueError:
+        raise control.ControlError("invalid run number " + args[0])
+    if not 0 < runID <= len(tasRuns):
+        raise control.ControlError("invalid run number " + args[0])
+    return runID - 1
+
+
+def controlLoad(args):
+    """load <file>: load a saved run, answers with its run number"""
+    if not args:
+        raise control.ControlError("no file given")
+    filename = ' '.join(args)
+    if not os.path.isfile(filename):
+        raise control.ControlError("file " + filename + " does not exist")
+    try:
+        load(filename)
+    except ValueError as e:
+        raise control.ControlError(str(e))
+    return str(len(tasRuns))
+
+
+def controlReset(args):
+    """reset [run|all]: reset a run back to frame 0"""
+    if args and args[0].lower() == 'all':
+        runInLoop(resetAll)
+    else:
+        runInLoop(resetRun, controlRunIndex(args))
+
+
+def controlSeek(args):
+    """seek <run> <frame> [movie]: jump a run to a frame (movie: not counting blank frames), answers with the run frame"""
+    if len(args) not in (2, 3) or (len(args) == 3 and args[2].lower() != 'movie'):
+        raise control.ControlError("usage: seek <run> <frame> [movie]")
+    index = controlRunIndex(args[:1])
+    try:
+        frame = int(args[1])
+    except ValueError:
+        raise control.ControlError("invalid frame number " + args[1])
+    target = getSeekFrame(index, frame, len(args) == 3)
+    if target is None:
+        raise control.ControlError("frame " + args[1] + " is outside run " + args[0])
+    runInLoop(seekRun, index, target)
+    return str(target)
+
+
+def controlOverlay(args):
+    """overlay <run> <frame|next> <file> [lanes] | overlay <run> clear: splice input over a run's frames"""
+    if len(args) == 2 and args[1].lower() == 'clear':
+        runInLoop(clearOverlays, controlRunIndex(args[:1]))
+        return None
+    if len(args) not in (3, 4):
+        raise control.ControlError("usage: overlay <run> <frame|next> <file> [lane,lane...] or overlay <run> clear")
+    index = controlRunIndex(args[:1])
+    try:
+        start, encoded, positions = readOverlay(index, args[1:])
+    except ValueError as e:
+        raise control.ControlError(str(e))
+    return "%d %d" % runInLoop(overlayRun, index, start, encoded, positions)
+
+
+def controlRemove(args):
+    """remove [run]: remove a run, without saving it"""
+    runInLoop(removeRun, controlRunIndex(args))
+
+
+def controlOn(args):
+    """on: release the console's reset pin"""
+    runInLoop(write_data, protocol.RELEASE_CONSOLE)
+
+
+def controlOff(args):
+    """off: hold the console in reset"""
+    runInLoop(write_data, protocol.HOLD_CONSOLE)
+
+
+def controlRestart(args):
+    """restart [all]: hold the consoles in reset and restart every run (a single run only when it's the only one)"""
+    if args and args[0].lower() == 'all':
+        indexes = range(len(tasRuns))
+    else:
+        indexes = [controlRunIndex(args)]
+    try:
+        startRuns(indexes, monotonic() + max(START_HOLD, START_LEAD), START_HOLD, False)
+    except ValueError as e:
+        raise control.ControlError(str(e))
+
+
+def controlStart(args):
+    """start [all] [in <seconds>|at <time>] [hold <ms>]: start every console and run on the board together, as JSON"""
+    if not tasRuns:
+        raise control.ControlError("no active runs")
+    try:
+        indexes, at, hold = readStart(args)
+        return startRuns(indexes, at, hold)
+    except ValueError as e:
+        raise control.ControlError(str(e))
+
+
+def controlClock(args):
+    """clock: the daemon's monotonic time, for picking a start time"""
+    return repr(monotonic())
+
+
+def getStatus():
+    # applied on the serial thread, so everything comes from the same moment
+    runs = []
+    for index, run in enumerate(tasRuns):
+        runs.append({'run': index + 1, 'file': run.inputFile, 'ports': run.portsList, 'frame': frameCounts[index],
+                     'frames': len(frameSources[index]), 'buffered': fifoLevels[index], 'prebuffer': getPrebuffer(run),
+                     'underruns': underrunCounts[index], 'modified': isRunModified[index],
+                     'overlays': len(frameSources[index].overlays)})
+    return {'selected': selected_run + 1, 'runs': runs, 'unknown_responses': unknownResponseCount}
+
+
+def controlStatus(args):
+    """status: the active runs and how far along they are, as JSON"""
+    return runInLoop(getStatus)
+
+
+def controlPing(args):
+    """ping: check the daemon is there"""
+    return "pong"
+
+
+def controlShutdown(args):
+    """shutdown: stop streaming and exit"""
+    server.stop()
+
+
+def controlHelp(args):
+    """help: list the commands"""
+    return '; '.join([controlHandlers[name].__doc__ for name in sorted(controlHandlers)])
+
+
+controlHandlers = {
+    'load': controlLoad,
+    'reset': controlReset,
+    'seek': controlSeek,
+    'overlay': controlOverlay,
+    'remove': controlRemove,
+    'on': controlOn,
+    'off': controlOff,
+    'restart': controlRestart,
+    'start': controlStart,
+    'clock': controlClock,
+    'status': controlStatus,
+    'ping': controlPing,
+    'help': controlHelp,
+}
+
 # ----- MAIN EXECUTION BEGINS HERE -----
 
+daemonSocket = None
+if len(sys.argv) > 2 and sys.argv[1] == '--daemon':  # no CLI, take commands over a socket instead
+    daemonSocket = sys.argv[2]
+    del sys.argv[1:3]
+
 if len(sys.argv) < 2:
     sys.stderr.write('Usage: ' + sys.argv[0] + ' <interface>\n\n')
     sys.stderr.write('OR: ' + sys.argv[0] + ' <interface> <file1> <file2> ... \n\n')
+    sys.stderr.write('OR: ' + sys.argv[0] + ' --daemon <socket> <interface> <file1> <file2> ... \n\n')
     sys.exit(0)
 
+if daemonSocket:
+    try:
+        server = control.ControlServer(daemonSocket, controlHandlers)
+    except control.ControlError as e:
+        print("ERROR: " + str(e))
+        sys.exit(0)
+    controlHandlers['shutdown'] = controlShutdown
+
 if TASLINK_CONNECTED:
     try:
-        ser = serial.Serial(sys.argv[1], baud)
+        ser = serial.Serial(sys.argv[1], baud, timeout=readTimeout)
     except SerialException:
         print ("ERROR: the specified interface (" + sys.argv[1] + ") is in use")
         sys.exit(0)
+    if recordFile:
+        try:
+            ser = recorder.RecordingSerial(ser, recordFile)
+            print("Recording the serial session to " + recordFile)
+        except (IOError, OSError, ValueError) as e:
+            print("WARNING: not recording the serial session: " + str(e))
 
     # ensure we start with all events disabled
-    for x in range(1,5):
-        ser.write("se"+str(x)+chr(0)+chr(0))
+    ser.write(protocol.eventsOff())
+
+exporters = []
+try:
+    if metricsAddress:
+        exporters.append(metrics.MetricsServer(metrics.parseAddress(metricsAddress), collectMetrics))
+        print("Serving metrics on http://%s:%d/metrics" % metrics.parseAddress(metricsAddress))
+    if metricsFile:
+        exporters.append(metrics.MetricsFile(metricsFile, collectMetrics))
+        print("Writing metrics to " + metricsFile)
+except (IOError, OSError, ValueError) as e:
+    print("WARNING: not exporting metrics: " + str(e))
+metricsEnabled = bool(exporters)
 
 if len(sys.argv) > 2:  # load some initial files!
     for filename in sys.argv[2:]:
         if not os.path.isfile(filename):
             print("ERROR: File "+filename+" does not exist!")
             continue
-        load(filename)
-
-# start CLI in its own thread
-cli = CLI()
-t = threading.Thread(target=cli.cmdloop)  # no parens on cmdloop is important... otherwise it blocks
+        try:
+            load(filename)
+        except ValueError as e:
+            print("ERROR: " + str(e) + "!")
+
+if daemonSocket:
+    # the control socket takes the place of the CLI, and stopping it ends the session
+    t = threading.Thread(target=server.serve)
+    signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    print("Listening for commands on " + daemonSocket)
+else:
+    # start CLI in its own thread
+    cli = CLI()
+    t = threading.Thread(target=cli.cmdloop)  # no parens on cmdloop is important... otherwise it blocks
 t.start()
 
 # main thread of execution = serial communication thread
 # keep loop as tight as possible to eliminate communication overhead
-while t.isAlive() and not inputBuffers:  # wait until we have at least one run ready to go
-    pass
+try:
+    while t.isAlive() and not frameSources:  # wait until we have at least one run ready to go
+        applyCommands(readTimeout)
 
-if TASLINK_CONNECTED and not t.isAlive():
-    ser.close()
-    sys.exit(0)
+    if TASLINK_CONNECTED and not t.isAlive():
+        ser.close()
+        sys.exit(0)
 
-# t3h urn
-if TASLINK_CONNECTED:
-    while t.isAlive():
+    # t3h urn
+    if TASLINK_CONNECTED:
+        while t.isAlive():
 
-        while ser.inWaiting() == 0 and t.isAlive():
-            pass
+            # block until the board sends something rather than spinning on inWaiting()
+            # the timeout bounds how long it takes us to notice the CLI has exited or has something for us
+            c = ser.read(1)
+            if not c:
+                applyCommands()
+                continue
+            latchTime = monotonic()
 
-        if not t.isAlive():
-            ser.close() # close serial communication cleanly
-            break
+            numBytes = ser.inWaiting()
+            if numBytes > 0:
+                c += ser.read(numBytes)
 
-        numBytes = ser.inWaiting()
-        c = ser.read(numBytes)
-        latchCounts = [-1, c.count('f'), c.count('g'), c.count('h'), c.count('i')]
+            # every run that latched gets refilled in a single write
+            batch = demuxLatches(c)
+            if latencyRings is None:
+                write_data(''.join([latched(run_index, latches) for run_index, latches in batch.iteritems()]))
+            else:
+                instrumentedRefill(latchTime, batch)
+            if startWatch is not None:
+                watchStart(latchTime, batch)
+            if metricsEnabled:
+                recordLoop(latchTime)
+
+            # the frames are out, now is a safe time for anything the CLI wants changed
+            if not commandQueue.empty():
+                applyCommands()
 
-        for run_index, run in enumerate(tasRuns):
-            port = min(run.portsList) # the same port we have an event listener on
-            latches = latchCounts[port]
-            if latches > 0:
-                send_frames(run_index, latches)
+        ser.close() # close serial communication cleanly
+    else:
+        while t.isAlive():  # nothing to stream, just look after the CLI
+            applyCommands(readTimeout)
+finally:
+    serialStopped = True
@@ -0,0 +1,520 @@
+import argparse
+import collections
+import json
+import os
+import platform
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import board_emulator
+import frames
+import instrument
+from clock import monotonic
+
+# End-to-end streaming benchmark. Runs TASLink.py against the board emulator with simulated consoles latching at a
+# given rate, and measures how long the host takes from sending a latch byte to writing the next frame. With --n64 it
+# does the same for stream_N64.py against the emulated N64 board, with the console polling its controller instead.
+# --micro skips the board and times only how the serial loop puts together each write.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TASLINK = os.path.join(HERE, 'TASLink.py')
+STREAM_N64 = os.path.join(HERE, 'stream_N64.py')
+
+PREBUFFER = 60  # what TASLink.py prebuffers before the consoles start
+SETTLE_TIMEOUT = 15.0  # seconds to wait for TASLink.py to load and prebuffer
+OVERLAY_SPACING = 8  # --micro: frames between overlay starts, each overlay covers half of them
+
+CONTROLLER_TYPES = collections.OrderedDict([('normal', 0), ('y', 1), ('multitap', 2)])
+RATES = {'ntsc': board_emulator.NTSC_RATE, 'pal': board_emulator.PAL_RATE}
+
+RUN_TEMPLATE = """!!python/object:__main__.TASRun
+controllerBits: 16
+controllerType: %(controllerType)d
+dpcmFix: false
+dummyFrames: 0
+fileExtension: r16m
+inputFile: %(inputFile)s
+maxControllers: 8
+numControllers: 1
+overread: 0
+portsList: [%(port)d]
+window: 0.0
+"""
+
+
+class TimedBoard(board_emulator.TASLinkBoard):
+    # remembers when each latch byte went out, and matches it against the next frame written to that port's lanes
+    def __init__(self):
+        board_emulator.TASLinkBoard.__init__(self)
+        self.now = 0.0
+        self.pending = [None] + [collections.deque() for port in range(board_emulator.NUM_PORTS)]
+        self.seen = [None] + [0] * board_emulator.NUM_PORTS
+        self.latencies = []
+
+    def latch(self, port, now):
+        self.now = now
+        return board_emulator.TASLinkBoard.latch(self, port, now)
+
+    def poll(self, now):
+        self.now = now
+        return board_emulator.TASLinkBoard.poll(self, now)
+
+    def fire(self, event):
+        out = board_emulator.TASLinkBoard.fire(self, event)
+        if out:
+            self.pending[event.port].append(self.now)
+        return out
+
+    def firstLane(self, port):
+        mask = self.events[port].laneMask
+        for lane in range(1, board_emulator.NUM_LANES + 1):
+            if mask & (1 << (lane - 1)):
+                return self.lanes[lane]
+        return None
+
+    def skipWritten(self):
+        # frames already written (the prebuffer) don't answer any latch
+        for port in range(1, board_emulator.NUM_PORTS + 1):
+            lane = self.firstLane(port)
+            if lane is not None:
+                self.seen[port] = lane.written
+
+    def received(self, data, now):
+        for port in range(1, board_emulator.NUM_PORTS + 1):
+            lane = self.firstLane(port)
+            if lane is None:
+                continue
+            pending = self.pending[port]
+            while self.seen[port] < lane.written:
+                self.seen[port] += 1
+                if pending:
+                    self.latencies.append(now - pending.popleft())
+
+
+class TimedN64Board(board_emulator.N64Board):
+    # same idea as TimedBoard for the single fifo on the N64 board
+    def __init__(self):
+        board_emulator.N64Board.__init__(self)
+        self.pending = collections.deque()
+        self.seen = 0
+        self.latencies = []
+
+    def latch(self, port, now):
+        self.pending.append(now)
+        return board_emulator.N64Board.latch(self, port, now)
+
+    def skipWritten(self):
+        self.seen = self.lane.written
+
+    def received(self, data, now):
+        while self.seen < self.lane.written:
+            self.seen += 1
+            if self.pending:
+                self.latencies.append(now - self.pending.popleft())
+
+
+def processStats(pid):
+    # cpu seconds and rss in kB out of /proc, None where that isn't available
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+        rss = None
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+        return cpu, rss
+    except (IOError, OSError, IndexError, ValueError):
+        return None, None
+
+
+def makeMovie(path, frames):
+    # random button presses, every frame different so dropped or repeated frames would show
+    with open(path, 'wb') as f:
+        remaining = frames * 16
+        while remaining > 0:
+            chunk = min(remaining, 1 << 20)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+
+
+def makeM64(path, frames):
+    # version 3 header with one controller, then random inputs
+    header = bytearray(0x400)
+    header[0:8] = 'M64\x1a' + struct.pack('<I', 3)
+    header[0x15] = 1
+    header[0x18:0x1C] = struct.pack('<I', frames)
+    with open(path, 'wb') as f:
+        f.write(header)
+        remaining = frames * 4
+        while remaining > 0:
+            chunk = min(remaining, 1 << 20)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+
+
+def stopProcess(proc, exitCommand=None):
+    if exitCommand:
+        try:
+            proc.stdin.write(exitCommand)
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+    elif proc.poll() is None:
+        proc.send_signal(signal.SIGINT)
+    deadline = time.time() + 5
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+
+def scenarioEnv(workdir):
+    # the run cache goes in the work directory, so random benchmark movies never crowd real ones out of the user's cache
+    env = dict(os.environ)
+    env['TASLINK_CONNECTED'] = '1'
+    env['TASLINK_CACHE_DIR'] = os.path.join(workdir, 'cache')
+    return env
+
+
+def latencyResult(latches, latencies, underruns, overruns, cpuStart, cpuEnd, rss, wall):
+    result = collections.OrderedDict()
+    result['latches'] = latches
+    result['frames_written'] = len(latencies)
+    latencies = sorted(latencies)
+    result['latency_ms'] = collections.OrderedDict([
+        ('p50', instrument.percentile(latencies, 0.50) * 1e3 if latencies else None),
+        ('p99', instrument.percentile(latencies, 0.99) * 1e3 if latencies else None),
+        ('max', latencies[-1] * 1e3 if latencies else None)])
+    result['underruns'] = underruns
+    result['overruns'] = overruns
+    if cpuStart is not None and cpuEnd is not None:
+        result['cpu_percent'] = 100.0 * (cpuEnd - cpuStart) / wall
+    else:
+        result['cpu_percent'] = None
+    result['rss_kb'] = rss
+    return result
+
+
+def runScenario(workdir, controllerType, numRuns, rate, duration):
+    # returns a dict of results for one streaming session
+    ports = range(1, numRuns + 1)
+    movie = os.path.join(workdir, 'movie.r16m')
+    makeMovie(movie, int(rate * duration * 1.2) + PREBUFFER + 600)
+    runFiles = []
+    for port in ports:
+        runFile = os.path.join(workdir, 'run%d.yml' % port)
+        with open(runFile, 'w') as f:
+            f.write(RUN_TEMPLATE % {'controllerType': controllerType, 'inputFile': movie, 'port': port})
+        runFiles.append(runFile)
+
+    board = TimedBoard()
+    board.consoleHeld = True  # consoles stay off until every run has its prebuffer
+    master, slave, name = board_emulator.openPty()
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen([sys.executable, TASLINK, name] + runFiles, stdin=subprocess.PIPE, stdout=devnull,
+                                stderr=devnull, cwd=workdir, env=scenarioEnv(workdir))
+    try:
+        def prebuffered():
+            for port in ports:
+                lane = board.firstLane(port)
+                if lane is None or lane.written < PREBUFFER:
+                    return False
+            return True
+
+        consoles = [board_emulator.Console([port], rate, monotonic()) for port in ports]
+        board_emulator.serve(board, master, consoles, SETTLE_TIMEOUT, stop=prebuffered)
+        if not prebuffered():
+            return {'error': "TASLink.py did not prebuffer within %d seconds" % SETTLE_TIMEOUT}
+        board.skipWritten()
+
+        board.consoleHeld = False
+        start = monotonic()
+        consoles = [board_emulator.Console([port], rate, start) for port in ports]
+        cpuStart = processStats(proc.pid)[0]
+        board_emulator.serve(board, master, consoles, duration, onData=board.received)
+        wall = monotonic() - start
+        cpuEnd, rss = processStats(proc.pid)
+    finally:
+        stopProcess(proc, "exit\n")
+        os.close(master)
+        os.close(slave)
+
+    lanes = [board.lanes[lane] for lane in range(1, board_emulator.NUM_LANES + 1)]
+    return latencyResult(sum(board.events[port].latches for port in ports), board.latencies,
+                         max(lane.underruns for lane in lanes), max(lane.overruns for lane in lanes), cpuStart, cpuEnd,
+                         rss, wall)
+
+
+def runN64Scenario(workdir, rate, duration):
+    # stream_N64.py against the N64 board with the console polling at rate
+    movie = os.path.join(workdir, 'movie.m64')
+    makeM64(movie, int(rate * duration * 1.2) + PREBUFFER + 600)
+
+    board = TimedN64Board()
+    master, slave, name = board_emulator.openPty()
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen([sys.executable, STREAM_N64, name, movie, str(PREBUFFER)], stdout=devnull,
+                                stderr=devnull, cwd=workdir, env=scenarioEnv(workdir))
+    try:
+        def prebuffered():
+            return board.lane.written >= PREBUFFER
+
+        # the console doesn't poll until the prebuffer is in, there's no console to hold so just don't serve any
+        board_emulator.serve(board, master, [], SETTLE_TIMEOUT, stop=prebuffered)
+        if not prebuffered():
+            return {'error': "stream_N64.py did not prebuffer within %d seconds" % SETTLE_TIMEOUT}
+        board.skipWritten()
+
+        start = monotonic()
+        consoles = [board_emulator.Console([1], rate, start)]
+        cpuStart = processStats(proc.pid)[0]
+        board_emulator.serve(board, master, consoles, duration, onData=board.received)
+        wall = monotonic() - start
+        cpuEnd, rss = processStats(proc.pid)
+    finally:
+        stopProcess(proc)
+        os.close(master)
+        os.close(slave)
+
+    return latencyResult(board.polls, board.latencies, board.lane.underruns, board.lane.overruns, cpuStart, cpuEnd,
+                         rss, wall)
+
+
+class FrameViews(object):
+    # FrameSource handing out memoryview slices of its store instead of new strings
+    def __init__(self, source):
+        self.store = memoryview(bytearray(source.store))
+        self.frameSize = source.frameSize
+
+    def __len__(self):
+        return len(self.store) // self.frameSize
+
+    def getFrames(self, start, amount):
+        end = min(start + amount, len(self))
+        if start >= end:
+            return ""
+        return self.store[start * self.frameSize:end * self.frameSize]
+
+
+def microBenchmark(workdir, numRuns, batches):
+    # times putting together the data for one latch batch (one frame for each run) and writing it, three ways:
+    # encoding each frame from the movie as it's sent (how runs were streamed before frames.FrameSource kept them
+    # encoded), slicing new strings out of the encoded run (FrameSource now), and handing memoryview slices of it to
+    # the write, joining them only when a batch refills more than one run. Then slicing again with the runs covered
+    # in overlays, to time looking them up
+    movie = os.path.join(workdir, 'micro.r16m')
+    makeMovie(movie, 65536)
+    gatherMap = [0, 1]
+    sources = [frames.FrameSource(movie, 'A', gatherMap, 16) for run in range(numRuns)]
+    views = [FrameViews(source) for source in sources]
+    overlaid = [frames.FrameSource(movie, 'A', gatherMap, 16) for run in range(numRuns)]
+    for source in overlaid:
+        for start in range(0, len(source), OVERLAY_SPACING):  # about 8000 overlays on the first lane
+            source.addOverlay(start, 'A\0\0' * (OVERLAY_SPACING // 2), [1])
+    with open(movie, 'rb') as f:
+        raw = f.read()
+    numFrames = len(sources[0])
+    fd = os.open(os.devnull, os.O_WRONLY)
+
+    def encode(frame):
+        os.write(fd, ''.join([str(frames.encodeFrames(raw[frame * 16:(frame + 1) * 16], 'A', gatherMap, 16))
+                              for source in sources]))
+
+    def slices(frame):
+        os.write(fd, ''.join([source.getFrames(frame, 1) for source in sources]))
+
+    def memoryviews(frame):
+        data = [source.getFrames(frame, 1) for source in views]
+        if len(data) == 1:
+            os.write(fd, data[0])
+        else:
+            os.write(fd, ''.join([view.tobytes() for view in data]))
+
+    def overlays(frame):
+        os.write(fd, ''.join([source.getFrames(frame, 1) for source in overlaid]))
+
+    result = collections.OrderedDict()
+    try:
+        for name, send in (('encode', encode), ('slice', slices), ('memoryview', memoryviews), ('overlay', overlays)):
+            start = monotonic()
+            for batch in xrange(batches):
+                send(batch % numFrames)
+            result[name + '_us'] = (monotonic() - start) * 1e6 / batches
+    finally:
+        os.close(fd)
+    return result
+
+
+def sustainable(result):
+    return 'error' not in result and result['underruns'] == 0 and result['overruns'] == 0
+
+
+def findMaxRate(scenario, duration, ceiling):
+    # double the latch rate until the host falls behind, then bisect between the last good and first bad rate.
+    # scenario(rate, duration) runs one measurement
+    good = None
+    bad = None
+    rate = board_emulator.NTSC_RATE
+    while rate <= ceiling:
+        if sustainable(scenario(rate, duration)):
+            good = rate
+            rate *= 2
+        else:
+            bad = rate
+            break
+    if bad is None:
+        return good
+    if good is None:
+        return None
+    for step in range(3):
+        rate = (good + bad) / 2.0
+        if sustainable(scenario(rate, duration)):
+            good = rate
+        else:
+            bad = rate
+    return good
+
+
+def compare(results, baselineFile, tolerance):
+    # print anything noticeably worse than the baseline, returns how many regressions there were
+    with open(baselineFile) as f:
+        baseline = dict((r['name'], r) for r in json.load(f)['results'])
+    regressions = 0
+    for result in results:
+        old = baseline.get(result['name'])
+        if old is None or 'error' in result or 'error' in old:
+            continue
+        checks = []
+        if 'latency_ms' in result and 'latency_ms' in old:
+            checks = [('latency p99', result['latency_ms']['p99'], old['latency_ms']['p99']),
+                      ('cpu', result['cpu_percent'], old['cpu_percent']),
+                      ('rss', result['rss_kb'], old['rss_kb'])]
+        for label, new, before in checks:
+            if new is not None and before and new > before * (1 + tolerance):
+                print("REGRESSION %s: %s %.2f -> %.2f" % (result['name'], label, before, new))
+                regressions += 1
+        for key in ('encode_us', 'slice_us', 'memoryview_us', 'overlay_us'):
+            if key in result and old.get(key) and result[key] > old[key] * (1 + tolerance):
+                print("REGRESSION %s: %s %.2f -> %.2f" % (result['name'], key, old[key], result[key]))
+                regressions += 1
+        if old.get('max_rate') and result.get('max_rate') is not None and \
+                result['max_rate'] < old['max_rate'] * (1 - tolerance):
+            print("REGRESSION %s: max rate %.0f -> %.0f" % (result['name'], old['max_rate'], result['max_rate']))
+            regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TASLink.py streaming against the board emulator.")
+    parser.add_argument('--types', default='normal,y,multitap', help="controller types (default normal,y,multitap)")
+    parser.add_argument('--runs', default='1,2,3,4', help="numbers of concurrent runs (default 1,2,3,4)")
+    parser.add_argument('--rates', default='ntsc,pal,600', help="latch rates: ntsc, pal or Hz (default ntsc,pal,600)")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds per measurement (default 5)")
+    parser.add_argument('--n64', action='store_true', help="benchmark stream_N64.py on the N64 board instead")
+    parser.add_argument('--micro', action='store_true', help="only time putting each write together, no board")
+    parser.add_argument('--batches', type=int, default=200000, help="latch batches per --micro timing (default 200000)")
+    parser.add_argument('--max-rate', action='store_true', help="also search for the highest sustainable latch rate")
+    parser.add_argument('--ceiling', type=float, default=8000.0, help="stop the max rate search here (default 8000)")
+    parser.add_argument('--output', default='benchmark-results.json', help="where to write the JSON results")
+    parser.add_argument('--baseline', help="earlier results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown vs. baseline (default 0.25)")
+    args = parser.parse_args()
+
+    types = args.types.split(',')
+    runCounts = [int(x) for x in args.runs.split(',')]
+    rates = [(r, RATES.get(r.lower()) or float(r)) for r in args.rates.split(',')]
+
+    workdir = tempfile.mkdtemp(prefix='taslink-bench-')
+    results = []
+    try:
+        if args.micro:
+            types = []
+            for numRuns in runCounts:
+                result = collections.OrderedDict()
+                result['name'] = "micro x%d" % numRuns
+                result['runs'] = numRuns
+                result.update(microBenchmark(workdir, numRuns, args.batches))
+                results.append(result)
+                print("%-28s per batch: encode %6.2fus  slice %6.2fus  memoryview %6.2fus  overlay %6.2fus" % (
+                    result['name'], result['encode_us'], result['slice_us'], result['memoryview_us'],
+                    result['overlay_us']))
+                sys.stdout.flush()
+        elif args.n64:
+            types = []
+            for rateName, rate in rates:
+                result = collections.OrderedDict()
+                result['name'] = "n64 @ %s" % rateName
+                result['rate_hz'] = rate
+                result.update(runN64Scenario(workdir, rate, args.duration))
+                results.append(result)
+                printResult(result)
+            if args.max_rate:
+                result = collections.OrderedDict()
+                result['name'] = "n64 max rate"
+                result['max_rate'] = findMaxRate(lambda rate, duration: runN64Scenario(workdir, rate, duration),
+                                                 min(args.duration, 3.0), args.ceiling)
+                results.append(result)
+                print("%-28s max sustainable poll rate %s Hz" % (result['name'], result['max_rate']))
+        for typeName in types:
+            controllerType = CONTROLLER_TYPES[typeName]
+            for numRuns in runCounts:
+                if controllerType == CONTROLLER_TYPES['multitap'] and numRuns > 2:
+                    continue  # multitap only works on ports 1 and 2
+                for rateName, rate in rates:
+                    result = collections.OrderedDict()
+                    result['name'] = "%s x%d @ %s" % (typeName, numRuns, rateName)
+                    result['controller_type'] = typeName
+                    result['runs'] = numRuns
+                    result['rate_hz'] = rate
+                    result.update(runScenario(workdir, controllerType, numRuns, rate, args.duration))
+                    results.append(result)
+                    printResult(result)
+                if args.max_rate:
+                    result = collections.OrderedDict()
+                    result['name'] = "%s x%d max rate" % (typeName, numRuns)
+                    result['controller_type'] = typeName
+                    result['runs'] = numRuns
+                    result['max_rate'] = findMaxRate(
+                        lambda rate, duration: runScenario(workdir, controllerType, numRuns, rate, duration),
+                        min(args.duration, 3.0), args.ceiling)
+                    results.append(result)
+                    print("%-28s max sustainable latch rate %s Hz" % (result['name'], result['max_rate']))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = collections.OrderedDict()
+    output['date'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    output['python'] = platform.python_version()
+    output['platform'] = platform.platform()
+    output['duration'] = args.duration
+    output['results'] = results
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print("Results written to " + args.output)
+
+    if args.baseline:
+        if compare(results, args.baseline, args.tolerance):
+            sys.exit(1)
+
+
+def printResult(result):
+    if 'error' in result:
+        print("%-28s ERROR: %s" % (result['name'], result['error']))
+        return
+    latency = result['latency_ms']
+    print("%-28s p50 %6.3fms  p99 %6.3fms  max %7.3fms  cpu %5.1f%%  rss %6s kB  underruns %d  overruns %d" % (
+        result['name'], latency['p50'] or 0, latency['p99'] or 0, latency['max'] or 0, result['cpu_percent'] or 0,
+        result['rss_kb'], result['underruns'], result['overruns']))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,495 @@
+import argparse
+import collections
+import errno
+import os
+import select
+import sys
+import tty
+
+import protocol
+from clock import monotonic
+
+# Software stand-in for the TASLink board, following the UART protocol in HDL/TASLink/main.vhd, or with --n64 the
+# single controller design in HDL/N64/main.vhd.
+# It sits on the master side of a pty, so TASLink.py, stream_NES.py and stream_N64.py can open the slave side like any
+# serial port.
+
+NUM_LANES = 8
+NUM_PORTS = 4
+
+NTSC_RATE = 60.0988
+PAL_RATE = 50.0070
+
+WINDOW_STEP = 0.00025  # event timers count in 0.25ms steps
+
+# uart states from main.vhd
+MAIN_CMD = 0
+RESET_DATA = 1
+BUTTON_DATA_CMD = 2
+SETUP_CMD_DATA1 = 3
+SETUP_CMD_DATA2 = 4
+SETUP_CMD_DATA3 = 5
+SETUP_CMD_DATA4 = 6
+
+
+class Lane(object):
+    def __init__(self, number):
+        self.number = number
+        self.fifo = collections.deque()
+        self.connected = 0
+        self.overread = 0
+        self.size = 1  # bytes per frame
+        self.last = 0xFFFFFFFF  # what the console sees when the fifo runs dry
+
+        self.written = 0
+        self.consumed = 0
+        self.underruns = 0
+        self.overruns = 0
+        self.peak = 0
+
+    def write(self, value):
+        if len(self.fifo) >= protocol.FIFO_CAPACITY:
+            self.overruns += 1
+            return False
+        self.fifo.append(value)
+        self.written += 1
+        if len(self.fifo) > self.peak:
+            self.peak = len(self.fifo)
+        return True
+
+    def read(self):
+        if not self.fifo:
+            self.underruns += 1
+            return False
+        self.last = self.fifo.popleft()
+        self.consumed += 1
+        return True
+
+    def clear(self):
+        self.fifo.clear()
+
+
+class Event(object):
+    def __init__(self, port):
+        self.port = port
+        self.enabled = 0
+        self.restart = 0
+        self.length = 20 if port <= 2 else 0  # power-on defaults in main.vhd
+        self.laneMask = 0
+        self.due = None  # when the running window timer fires
+
+        self.latches = 0
+        self.fired = 0
+
+
+class TASLinkBoard(object):
+    def __init__(self, report=None):
+        self.lanes = [None] + [Lane(x) for x in range(1, NUM_LANES + 1)]
+        self.events = [None] + [Event(x) for x in range(1, NUM_PORTS + 1)]
+        self.customMasks = [0, 0, 0, 0]
+        self.portConfig = [None, 0, 0, 0, 0]
+        self.portClockDelay = [None, 0, 0, 0, 0]
+        self.consoleHeld = False  # 'sd1' holds the consoles in reset
+        self.report = report  # called with a message on every underrun/overrun
+
+        self.state = MAIN_CMD
+        self.receiveMask = 0
+        self.controllerId = 1
+        self.byteId = 1
+        self.newData = 0
+        self.setupData = [0, 0, 0]
+
+        self.unknownBytes = 0
+
+    # ----- host -> board -----
+
+    def receive(self, data):
+        for c in data:
+            self.receiveByte(ord(c))
+
+    def receiveByte(self, b):
+        state = self.state
+        if state == MAIN_CMD:
+            if b == 0x66:  # 'f'
+                self.startData(0xFF)
+            elif 0x41 <= b <= 0x44:  # 'A' - 'D'
+                self.startData(self.customMasks[b - 0x41])
+            elif b == 0x52:  # 'R'
+                for lane in self.lanes[1:]:
+                    lane.clear()
+            elif b == 0x72:  # 'r'
+                self.state = RESET_DATA
+            elif b == 0x73:  # 's'
+                self.state = SETUP_CMD_DATA1
+            else:
+                self.unknownBytes += 1
+        elif state == RESET_DATA:
+            for lane in self.lanes[1:]:
+                if b & (1 << (lane.number - 1)):
+                    lane.clear()
+            self.state = MAIN_CMD
+        elif state == BUTTON_DATA_CMD:
+            self.buttonData(b)
+        elif state == SETUP_CMD_DATA1:
+            self.setupData[0] = b
+            self.state = SETUP_CMD_DATA2
+        elif state == SETUP_CMD_DATA2:
+            self.setupCommand2(b)
+        elif state == SETUP_CMD_DATA3:
+            self.setupCommand3(b)
+        elif state == SETUP_CMD_DATA4:
+            self.setupCommand4(b)
+
+    def startData(self, mask):
+        for lane in range(1, NUM_LANES + 1):
+            if mask & (1 << (lane - 1)):
+                self.receiveMask = mask
+                self.controllerId = lane
+                self.byteId = 1
+                self.newData = 0
+                self.state = BUTTON_DATA_CMD
+                return
+        self.state = MAIN_CMD  # empty mask, nothing to receive
+
+    def buttonData(self, b):
+        # bytes fill the lane's 32 bit word from the bottom up, unused bytes read as 1's
+        shift = 8 * (self.byteId - 1)
+        self.newData = (self.newData & ((1 << shift) - 1)) | (b << shift)
+        lane = self.lanes[self.controllerId]
+        if self.byteId >= lane.size:
+            value = self.newData | (0xFFFFFFFF & ~((1 << (8 * self.byteId)) - 1))
+            if not lane.write(value) and self.report:
+                self.report("OVERRUN on lane %d (fifo full, frame dropped)" % lane.number)
+            self.byteId = 1
+            self.newData = 0
+            for nextLane in range(self.controllerId + 1, NUM_LANES + 1):
+                if self.receiveMask & (1 << (nextLane - 1)):
+                    self.controllerId = nextLane
+                    return
+            self.state = MAIN_CMD
+        else:
+            self.byteId += 1
+
+    def setupCommand2(self, b):
+        cmd = self.setupData[0]
+        self.state = MAIN_CMD
+        if 0x41 <= cmd <= 0x44:  # 'sA' - 'sD'
+            self.customMasks[cmd - 0x41] = b
+        elif cmd in (0x63, 0x70, 0x65):  # 'c', 'p', 'e'
+            self.setupData[1] = b
+            self.state = SETUP_CMD_DATA3
+        elif cmd == 0x64:  # 'd'
+            if b == 0x31:
+                self.consoleHeld = True
+            else:
+                self.consoleHeld = False
+        # 'x' and anything else only touches debug outputs
+
+    def setupCommand3(self, b):
+        cmd = self.setupData[0]
+        target = self.setupData[1] - 0x30
+        self.state = MAIN_CMD
+        if cmd == 0x63:  # 'c'
+            if 1 <= target <= NUM_LANES:
+                lane = self.lanes[target]
+                lane.connected = (b >> 7) & 1
+                lane.overread = (b >> 6) & 1
+                lane.size = (b & 0x03) + 1
+        elif cmd == 0x70:  # 'p'
+            if 1 <= target <= NUM_PORTS:
+                self.portConfig[target] = b & 0x7F
+                self.portClockDelay[target] = (b >> 7) & 1
+        elif cmd == 0x65:  # 'e'
+            self.setupData[2] = b
+            self.state = SETUP_CMD_DATA4
+
+    def setupCommand4(self, b):
+        target = self.setupData[1] - 0x30
+        self.state = MAIN_CMD
+        if self.setupData[0] == 0x65 and 1 <= target <= NUM_PORTS:
+            event = self.events[target]
+            event.enabled = (self.setupData[2] >> 7) & 1
+            event.restart = (self.setupData[2] >> 6) & 1
+            event.length = self.setupData[2] & 0x3F
+            event.laneMask = b
+            event.due = None
+
+    # ----- console -> board -----
+
+    def latch(self, port, now):
+        # rising edge of the latch line on a console port, returns anything the board sends back to the host
+        event = self.events[port]
+        event.latches += 1
+        if event.length == 0:
+            return self.fire(event)
+        # (re)start the window timer, latches inside the window are merged into one event
+        event.due = now + (event.length + 1) * WINDOW_STEP
+        return ""
+
+    def poll(self, now):
+        # fire any window timers that have run out
+        out = ""
+        for event in self.events[1:]:
+            if event.due is not None and event.due <= now:
+                event.due = None
+                out += self.fire(event)
+        return out
+
+    def nextDue(self):
+        due = [event.due for event in self.events[1:] if event.due is not None]
+        if due:
+            return min(due)
+        return None
+
+    def fire(self, event):
+        if not event.enabled:
+            return ""
+        event.fired += 1
+        for lane in self.lanes[1:]:
+            if event.laneMask & (1 << (lane.number - 1)):
+                if not lane.read() and self.report:
+                    self.report("UNDERRUN on lane %d (port %d latch #%d)" % (lane.number, event.port, event.latches))
+        return chr(0x65 + event.port)  # 'f' for port 1 ... 'i' for port 4
+
+    def summary(self):
+        lines = []
+        for event in self.events[1:]:
+            if event.latches or event.enabled:
+                lines.append("port %d: %d latches, %d events sent" % (event.port, event.latches, event.fired))
+        for lane in self.lanes[1:]:
+            if lane.written or lane.underruns or lane.overruns:
+                lines.append("lane %d: %d written, %d consumed, %d in fifo (peak %d), %d underruns, %d overruns" % (
+                    lane.number, lane.written, lane.consumed, len(lane.fifo), lane.peak, lane.underruns,
+                    lane.overruns))
+        if self.unknownBytes:
+            lines.append("%d unknown command bytes" % self.unknownBytes)
+        return "\n".join(lines)
+
+
+class N64Board(object):
+    # HDL/N64/main.vhd: 'f' and 4 bytes puts a 32 bit frame in the fifo, 'R' empties it. Every controller poll from
+    # the console (command 0x01) takes the next frame and sends an 'f' back, status and reset commands don't touch
+    # the fifo so they aren't modelled here.
+    def __init__(self, report=None):
+        self.lane = Lane(1)
+        self.lane.size = 4
+        self.consoleHeld = False  # the N64 design can't hold the console, this only lets a benchmark wait
+        self.report = report
+
+        self.receiving = False
+        self.byteId = 1
+        self.newData = 0
+
+        self.polls = 0
+        self.unknownBytes = 0
+
+    def receive(self, data):
+        for c in data:
+            self.receiveByte(ord(c))
+
+    def receiveByte(self, b):
+        if self.receiving:
+            # same as TASLink, bytes fill the word from the bottom up
+            shift = 8 * (self.byteId - 1)
+            self.newData |= b << shift
+            if self.byteId == 4:
+                if not self.lane.write(self.newData) and self.report:
+                    self.report("OVERRUN (fifo full, frame dropped)")
+                self.receiving = False
+            else:
+                self.byteId += 1
+        elif b == 0x66:  # 'f'
+            self.receiving = True
+            self.byteId = 1
+            self.newData = 0
+        elif b == 0x52:  # 'R'
+            self.lane.clear()
+        else:
+            self.unknownBytes += 1
+
+    def latch(self, port, now):
+        # a controller poll, an empty fifo still answers with whatever word it last held
+        self.polls += 1
+        if not self.lane.read() and self.report:
+            self.report("UNDERRUN (poll #%d)" % self.polls)
+        return 'f'
+
+    def poll(self, now):
+        return ""
+
+    def nextDue(self):
+        return None
+
+    def response(self):
+        # the 4 bytes the console got on the last poll, in the order it got them
+        return ''.join(chr((self.lane.last >> shift) & 0xFF) for shift in (24, 16, 8, 0))
+
+    def summary(self):
+        lines = ["%d polls" % self.polls]
+        lane = self.lane
+        lines.append("%d written, %d consumed, %d in fifo (peak %d), %d underruns, %d overruns" % (
+            lane.written, lane.consumed, len(lane.fifo), lane.peak, lane.underruns, lane.overruns))
+        if self.unknownBytes:
+            lines.append("%d unknown command bytes" % self.unknownBytes)
+        return "\n".join(lines)
+
+
+class Console(object):
+    # latches one or more ports at a fixed rate, like a console polling its controllers once per frame. With
+    # doubleLatch set, every doubleEvery'th frame latches a second time that many seconds after the first, the way NES
+    # games re-read the controllers when a DPCM sample might have corrupted the first read
+    def __init__(self, ports, rate, start, doubleLatch=0.0, doubleEvery=1):
+        self.ports = ports
+        self.period = 1.0 / rate
+        self.doubleLatch = doubleLatch
+        self.doubleEvery = doubleEvery
+        self.frame = 0
+        self.frameStart = start + self.period
+        self.nextLatch = self.frameStart
+        self.again = False  # whether nextLatch is the second latch of a frame
+        self.held = False  # in reset, no latches until it's released
+
+    def advance(self):
+        if self.doubleLatch and not self.again and self.frame % self.doubleEvery == 0:
+            self.again = True
+            self.nextLatch = self.frameStart + self.doubleLatch
+            return
+        self.again = False
+        self.frame += 1
+        self.frameStart += self.period
+        self.nextLatch = self.frameStart
+
+    def release(self, now):
+        # out of reset, the console starts its frames over
+        self.held = False
+        self.frame = 0
+        self.again = False
+        self.frameStart = now + self.period
+        self.nextLatch = self.frameStart
+
+
+def openPty(link=None):
+    master, slave = os.openpty()
+    tty.setraw(slave)  # no line discipline, every byte goes straight through
+    name = os.ttyname(slave)
+    if link:
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(name, link)
+    # we keep the slave open ourselves so the master doesn't see EIO whenever the host closes its end
+    return master, slave, name
+
+
+def serve(board, master, consoles, duration=None, stop=None, onLatch=None, onData=None):
+    # run the board against the pty until duration runs out (forever if None) or stop() returns True
+    now = monotonic()
+    end = None
+    if duration is not None:
+        end = now + duration
+    while (end is None or now < end) and not (stop and stop()):
+        wake = [console.nextLatch for console in consoles if not console.held]
+        due = board.nextDue()
+        if due is not None:
+            wake.append(due)
+        if end is not None:
+            wake.append(end)
+        timeout = None
+        if wake:
+            timeout = max(0.0, min(wake) - monotonic())
+
+        try:
+            readable = select.select([master], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        now = monotonic()
+        if readable:
+            try:
+                data = os.read(master, 65536)
+            except OSError as e:
+                if e.errno == errno.EIO:
+                    data = ""  # nobody has the other end open right now
+                else:
+                    raise
+            if data:
+                board.receive(data)
+                if onData:
+                    onData(data, now)
+
+        out = ""
+        for console in consoles:
+            if board.consoleHeld:
+                console.held = True
+                continue
+            if console.held:
+                console.release(now)
+            while console.nextLatch <= now:
+                for port in console.ports:
+                    if onLatch:
+                        onLatch(port, now)
+                    out += board.latch(port, now)
+                console.advance()
+        out += board.poll(now)
+        if out:
+            os.write(master, out)
+
+
+def parseRate(value):
+    if value.lower() == 'ntsc':
+        return NTSC_RATE
+    if value.lower() == 'pal':
+        return PAL_RATE
+    return float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate a TASLink board on a pty.")
+    parser.add_argument('--rate', default='ntsc', help="latch rate: ntsc, pal, or frames per second (default ntsc)")
+    parser.add_argument('--ports', default='1,2,3,4', help="console ports that latch, commas between (default 1,2,3,4)")
+    parser.add_argument('--link', help="also make a symlink to the pty at this path")
+    parser.add_argument('--duration', type=float, help="stop after this many seconds")
+    parser.add_argument('--quiet', action='store_true', help="don't print every underrun and overrun")
+    parser.add_argument('--double-latch', type=float, default=0.0,
+                        help="latch twice per frame, this many ms apart, like DPCM safe controller reads")
+    parser.add_argument('--double-every', type=int, default=1, help="only double latch every this many frames")
+    parser.add_argument('--n64', action='store_true', help="emulate the N64 board instead, polling at --rate")
+    args = parser.parse_args()
+
+    rate = parseRate(args.rate)
+    ports = [int(port) for port in args.ports.split(',')]
+
+    def report(message):
+        sys.stderr.write(message + "\n")
+
+    if args.n64:
+        board = N64Board(None if args.quiet else report)
+        ports = [1]  # one controller
+    else:
+        board = TASLinkBoard(None if args.quiet else report)
+    master, slave, name = openPty(args.link)
+    print(("N64" if args.n64 else "TASLink") + " emulator listening on " + name +
+          (" (" + args.link + ")" if args.link else ""))
+    if args.n64:
+        print("Polling the controller at " + str(rate) + " Hz")
+    else:
+        print("Latching ports " + ", ".join(str(port) for port in ports) + " at " + str(rate) + " Hz")
+    sys.stdout.flush()
+
+    # every port is its own console, starting together
+    start = monotonic()
+    consoles = [Console([port], rate, start, args.double_latch / 1000.0, args.double_every) for port in ports]
+    try:
+        serve(board, master, consoles, args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(board.summary())
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
+        os.close(master)
+        os.close(slave)
+
+
+if __name__ == '__main__':
+    main()
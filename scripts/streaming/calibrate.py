@@ -0,0 +1,90 @@
+# Window calibration: works out the smallest event window that merges a console's double latches.
+#
+# With the window off every latch on a port is its own event and takes a frame out of the run. Some consoles and games
+# latch more than once per frame (on the NES, games re-read the controller when a DPCM sample fetch may have corrupted
+# the first read), which makes a run use up frames too fast. TASLink's event timer fires (steps + 1) * 0.25ms after the
+# last latch it saw and starts over on every latch, where the window is steps * 0.25ms. So a window merges a cluster of
+# latches when every gap inside it is shorter than that, and keeps frames apart when the gap between frames is longer.
+#
+# The latch times come from the host side (see instrument.py), so they carry the serial link's jitter. A margin is added
+# to the longest gap measured to cover it. Latches that arrive in the same read have no gap we can measure, so a
+# recording where every cluster came in one read gives no window at all rather than the shortest one. Neither does a
+# recording whose two halves want windows more than STABLE_STEPS apart.
+
+import math
+
+import instrument
+import protocol
+
+WINDOW_STEP = protocol.WINDOW_STEP  # ms per step of the event timer
+MAX_STEPS = protocol.MAX_WINDOW_STEPS  # the 'se' event byte has 6 bits for the window
+DEFAULT_MARGIN = 0.5  # ms
+STABLE_STEPS = 1  # how far apart the windows for the two halves of a recording can be
+
+
+def analyze(latchTimes, counts, margin=DEFAULT_MARGIN):
+    # latchTimes are when each read from the board came in (seconds) and counts how many latches that read held.
+    # Returns a dict of what was seen and the recommended window in ms: 0.0 when nothing needs merging, None with the
+    # reason why when there's no window to recommend
+    intervals = [(latchTimes[i] - latchTimes[i - 1]) * 1000.0 for i in range(1, len(latchTimes))]
+    result = {'latches': int(sum(counts)), 'reads': len(latchTimes), 'frames': 0, 'clusters': 0,
+              'frame_interval': 0.0, 'gap': 0.0, 'max_gap': 0.0, 'frame_gap': 0.0, 'min_frame_gap': 0.0,
+              'window': None, 'reason': None}
+    if not intervals:
+        result['reason'] = 'too few latches'
+        return result
+
+    # gaps inside a cluster are far shorter than a frame, anything under half of a typical long interval is one
+    threshold = instrument.percentile(sorted(intervals), 0.9) / 2
+    gaps = []
+    frameGaps = []
+    clustered = [counts[0] > 1]  # per frame, whether it saw more than one latch
+    for i, interval in enumerate(intervals):
+        if interval < threshold:
+            gaps.append(interval)
+            clustered[-1] = True
+        else:
+            frameGaps.append(interval)
+            clustered.append(counts[i + 1] > 1)
+
+    result['frames'] = len(clustered)
+    result['clusters'] = sum(clustered)
+    frameGaps.sort()
+    result['frame_interval'] = instrument.percentile(frameGaps, 0.5)
+    # the odd late read stretches one interval and shortens the next, so go by the typical gaps rather than the
+    # extremes, which are still reported
+    result['frame_gap'] = instrument.percentile(frameGaps, 0.1)
+    result['min_frame_gap'] = frameGaps[0] if frameGaps else 0.0
+    if not result['clusters']:
+        result['window'] = 0.0
+        return result
+
+    # latches that came in with the same read were closer together than we could tell apart, but that doesn't say how
+    # close, so they're no help in sizing the window
+    if not gaps:
+        result['reason'] = 'unresolved gap'
+        return result
+    gaps.sort()
+    result['gap'] = instrument.percentile(gaps, 0.9)
+    result['max_gap'] = gaps[-1]
+    steps = max(1, int(math.ceil((result['gap'] + margin) / WINDOW_STEP)) - 1)
+    fires = (steps + 1) * WINDOW_STEP
+    if steps <= MAX_STEPS and (not frameGaps or result['frame_gap'] > fires + margin):
+        result['window'] = steps * WINDOW_STEP
+    else:
+        result['reason'] = 'merges frames'
+    return result
+
+
+def analyzeStable(latchTimes, counts, margin=DEFAULT_MARGIN):
+    # analyze() of the whole recording, but its window only stands when each half of the recording comes up with one
+    # no more than STABLE_STEPS from the other's. The halves are in result['halves']
+    result = analyze(latchTimes, counts, margin)
+    half = len(latchTimes) // 2
+    halves = [analyze(latchTimes[:half], counts[:half], margin)['window'],
+              analyze(latchTimes[half:], counts[half:], margin)['window']]
+    result['halves'] = halves
+    if result['window'] and (None in halves or abs(halves[0] - halves[1]) > STABLE_STEPS * WINDOW_STEP):
+        result['window'] = None
+        result['reason'] = 'unstable'
+    return result
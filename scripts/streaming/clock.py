@@ -0,0 +1,47 @@
+# A monotonic clock for timing latches and serial traffic. time.monotonic() only exists in Python 3, so on Python 2
+# we go straight to clock_gettime() on Linux, and fall back to the best wall clock elsewhere.
+
+import sys
+import time
+
+CLOCK_MONOTONIC = 1  # from <time.h> on Linux
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonic():
+            ts = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, "clock_gettime failed")
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()  # make sure it actually works here
+    except (OSError, AttributeError):
+        if sys.platform == 'win32':
+            monotonic = time.clock  # QueryPerformanceCounter on windows
+        else:
+            monotonic = time.time
+
+SPIN = 0.002  # seconds, sleep() can overshoot by about this much
+
+
+def sleepUntil(deadline):
+    # sleeps until the monotonic clock reaches deadline, spinning for the last couple of ms rather than trusting sleep()
+    while True:
+        left = deadline - monotonic()
+        if left <= 0:
+            return
+        if left > SPIN:
+            time.sleep(left - SPIN)
@@ -0,0 +1,129 @@
+# Local control socket for running TASLink.py headless (TASLink.py --daemon <socket> <interface> ...).
+#
+# The protocol is one line per request and one line per response over a Unix domain socket. A request is a command
+# name followed by its arguments separated by spaces. A response is "ok", "ok <result>" or "err <message>", where a
+# result that isn't plain text is JSON. A connection can send as many requests as it likes.
+
+import json
+import os
+import socket
+import stat
+import threading
+
+ACCEPT_TIMEOUT = 0.5  # how often the server checks whether it's been stopped
+
+
+class ControlError(Exception):
+    pass
+
+
+def isSocket(path):
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def formatResult(result):
+    if result is None or result is True:
+        return "ok"
+    if isinstance(result, basestring):
+        return "ok " + result
+    return "ok " + json.dumps(result, separators=(',', ':'))
+
+
+def formatError(message):
+    # a response is one line, so messages that span several (like YAML's) get folded onto it
+    return "err " + " ".join(message.split())
+
+
+class ControlServer(object):
+    # Listens on a Unix domain socket and calls handlers[command](args) for each request, on a thread per
+    # connection. A handler returns its result or raises ControlError.
+
+    def __init__(self, path, handlers):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ControlError("control sockets need Unix domain sockets, which this platform doesn't have")
+        self.path = path
+        self.handlers = handlers
+        self.stopped = threading.Event()
+
+        if isSocket(path):
+            try:
+                request(path, "ping")
+                raise ControlError(path + " is already in use")
+            except socket.error:
+                os.remove(path)  # left behind by a daemon that didn't shut down cleanly
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.listener.bind(path)
+            self.listener.listen(5)
+        except socket.error as e:
+            self.listener.close()
+            raise ControlError("can't listen on " + path + ": " + str(e))
+        self.listener.settimeout(ACCEPT_TIMEOUT)
+
+    def serve(self):
+        try:
+            while not self.stopped.is_set():
+                try:
+                    connection, _ = self.listener.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                handler = threading.Thread(target=self.handle, args=(connection,))
+                handler.daemon = True
+                handler.start()
+        finally:
+            self.listener.close()
+            if isSocket(self.path):
+                os.remove(self.path)
+
+    def stop(self):
+        self.stopped.set()
+
+    def handle(self, connection):
+        reader = connection.makefile('rb')
+        try:
+            for line in reader:
+                connection.sendall(self.dispatch(line.strip()) + "\n")
+                if self.stopped.is_set():
+                    break
+        except socket.error:
+            pass  # client went away
+        finally:
+            reader.close()
+            connection.close()
+
+    def dispatch(self, line):
+        if not line:
+            return "err empty request"
+        words = line.split()
+        command, args = words[0].lower(), words[1:]
+        if command not in self.handlers:
+            return "err unknown command " + command
+        try:
+            return formatResult(self.handlers[command](args))
+        except ControlError as e:
+            return formatError(str(e))
+        except Exception as e:
+            return formatError(e.__class__.__name__ + ": " + str(e))
+
+
+def request(path, line, timeout=5.0):
+    # sends one request and returns the response line, without the trailing newline
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        client.sendall(line + "\n")
+        response = ""
+        while not response.endswith("\n"):
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        return response.rstrip("\n")
+    finally:
+        client.close()
@@ -0,0 +1,222 @@
+# Bulk encoding of replay file data into TASLink frame commands.
+#
+# A replay file is a sequence of fixed size raw frames (2 bytes for r08, 16 bytes for r16/r16m). Each command we send
+# to TASLink is the custom stream command byte followed by one or more bytes picked out of a raw frame. The bytes to
+# pick are described by a "gather map": a list of offsets into one raw frame, in the order the lanes expect them.
+# Already encoded frames (see runcache.py) can be handed to a FrameSource instead of being encoded again.
+# NES/SNES buttons are active low so their bytes get inverted on the way out, N64 data goes out as it is.
+
+import bisect
+import mmap
+import os
+import Queue
+import threading
+
+INVERT_TABLE = ''.join(chr(~x & 0xFF) for x in range(256))  # flip our 1's and 0's to be hardware compliant
+
+ENCODE_CHUNK = 65536  # frames encoded at a time when a movie isn't in the run cache
+
+
+def invert(data):
+    return data.translate(INVERT_TABLE)
+
+
+def encodeFrames(rawData, customCommand, gatherMap, rawFrameSize, activeLow=True):
+    # returns a bytearray holding one command per complete raw frame in rawData, back to back
+    if rawFrameSize <= 0:
+        return bytearray()
+    numFrames = len(rawData) // rawFrameSize
+    stride = 1 + len(gatherMap)
+    encoded = bytearray(numFrames * stride)
+    end = numFrames * rawFrameSize
+    for lane, offset in enumerate(gatherMap):
+        encoded[lane + 1::stride] = rawData[offset:end:rawFrameSize]
+    if not activeLow:
+        encoded[0::stride] = customCommand * numFrames
+        return encoded
+    # gather first and invert afterwards, so we only ever invert the bytes we actually send
+    encoded[0::stride] = invert(customCommand) * numFrames
+    return encoded.translate(INVERT_TABLE)
+
+
+class FrameSource(object):
+    # Keeps a run's encoded frames in one contiguous block with a fixed stride (the command byte plus one byte per
+    # lane), so any range of frames is a single slice of it and nothing is encoded while streaming. The block is the
+    # mapped cache entry when there is one (see runcache.py), otherwise the movie is encoded into a bytearray once up
+    # front. Dummy frames are a virtual prefix in front of the movie rather than stored.
+    #
+    # Overlays replace some or all of the bytes of a range of frames without touching the store: each one is a copy of
+    # its frames with the new bytes patched in, made when it's added. They never overlap, a newer overlay cuts away
+    # the parts of older ones it covers, so a batch is put together from at most a few slices found by bisecting the
+    # sorted overlay starts.
+
+    def __init__(self, fileName, customCommand, gatherMap, rawFrameSize, dummyFrames=0, dummyFrame=None, encoded=None):
+        self.customCommand = customCommand
+        self.dummyFrames = dummyFrames
+        self.frameSize = 1 + len(gatherMap)
+        if dummyFrame is None:
+            dummyFrame = customCommand + '\xff' * len(gatherMap)
+        assert len(dummyFrame) == self.frameSize, "dummy frame is %d bytes, frames are %d" % (len(dummyFrame),
+                                                                                               self.frameSize)
+        self.dummyFrame = dummyFrame  # the command sent for each dummy frame
+        self.blanks = ""  # dummy frames to slice from, grown as needed
+
+        if encoded is None:
+            encoded = self.encodeMovie(fileName, customCommand, gatherMap, rawFrameSize)
+        elif len(encoded) > 0 and encoded[0] != customCommand:
+            # frames encoded ahead of time for another command, swap in ours once rather than on every send
+            encoded = bytearray(encoded)
+            encoded[0::self.frameSize] = customCommand * (len(encoded) // self.frameSize)
+        # slicing a buffer hands back a new string in one step, which for frames this small is cheaper than going
+        # through a memoryview (see benchmark.py --micro)
+        self.store = buffer(encoded)
+        self.movieFrames = len(self.store) // self.frameSize
+        self.overlayStarts = []  # first frame of each overlay, sorted
+        self.overlays = []  # (start, end, frames) for each overlay, in the same order
+
+    def encodeMovie(self, fileName, customCommand, gatherMap, rawFrameSize):
+        with open(fileName, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if rawFrameSize <= 0 or size < rawFrameSize:
+                return bytearray()
+            numFrames = size // rawFrameSize
+            store = bytearray(numFrames * self.frameSize)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for first in range(0, numFrames, ENCODE_CHUNK):
+                    last = min(first + ENCODE_CHUNK, numFrames)
+                    store[first * self.frameSize:last * self.frameSize] = encodeFrames(
+                        data[first * rawFrameSize:last * rawFrameSize], customCommand, gatherMap, rawFrameSize)
+            finally:
+                data.close()
+        return store
+
+    def setDummyFrames(self, dummyFrames):
+        # the movie data doesn't move, frames are just counted from a different place. Overlays are on run frames,
+        # which all move, so they go
+        self.dummyFrames = dummyFrames
+        self.removeOverlays()
+
+    def __len__(self):
+        return self.dummyFrames + self.movieFrames
+
+    def getFrames(self, start, amount):
+        # returns the commands for frames [start, start + amount) as one string, clipped to the end of the run
+        end = min(start + amount, len(self))
+        if start >= end:
+            return ""
+        if not self.overlays:
+            return self.getBaseFrames(start, end)
+
+        pieces = []
+        i = bisect.bisect_right(self.overlayStarts, start) - 1
+        if i < 0 or self.overlays[i][1] <= start:
+            i += 1
+        position = start
+        while position < end and i < len(self.overlays) and self.overlays[i][0] < end:
+            first, last, data = self.overlays[i]
+            if position < first:
+                pieces.append(self.getBaseFrames(position, first))
+                position = first
+            stop = min(last, end)
+            pieces.append(data[(position - first) * self.frameSize:(stop - first) * self.frameSize])
+            position = stop
+            i += 1
+        if position < end:
+            pieces.append(self.getBaseFrames(position, end))
+        return ''.join(pieces)
+
+    def getBaseFrames(self, start, end):
+        # frames [start, end) of the run as it was loaded, start < end <= len(self)
+        blanks = ""
+        if start < self.dummyFrames:
+            count = min(end, self.dummyFrames) - start
+            if len(self.blanks) < count * self.frameSize:
+                self.blanks = self.dummyFrame * count
+            blanks = self.blanks[:count * self.frameSize]
+            start = self.dummyFrames
+            if start >= end:
+                return blanks
+
+        return blanks + self.store[(start - self.dummyFrames) * self.frameSize:(end - self.dummyFrames) * self.frameSize]
+
+    def addOverlay(self, start, encoded, positions):
+        # lays frames encoded like the store's over the run from frame start, taking the bytes at positions (offsets
+        # into a frame) from them and the rest from the frames underneath. Returns the number of frames covered, the
+        # part past the end of the run is dropped
+        end = min(start + len(encoded) // self.frameSize, len(self))
+        if start < 0 or start >= end:
+            return 0
+        count = (end - start) * self.frameSize
+        if set(positions) == set(range(1, self.frameSize)):
+            frames = str(encoded[:count])  # nothing is kept from underneath, so there's nothing to merge
+        else:
+            frames = bytearray(self.getFrames(start, end - start))
+            for position in positions:
+                frames[position:count:self.frameSize] = encoded[position:count:self.frameSize]
+            frames = str(frames)
+        self.removeOverlays(start, end)
+        i = bisect.bisect_left(self.overlayStarts, start)
+        self.overlayStarts.insert(i, start)
+        self.overlays.insert(i, (start, end, frames))
+        return end - start
+
+    def removeOverlays(self, start=0, end=None):
+        # drops the overlays from frames [start, end), cutting down any that stick out past either side
+        if end is None:
+            end = len(self)
+        kept = []
+        for first, last, data in self.overlays:
+            if last <= start or first >= end:
+                kept.append((first, last, data))
+                continue
+            if first < start:
+                kept.append((first, start, data[:(start - first) * self.frameSize]))
+            if last > end:
+                kept.append((end, last, data[(end - first) * self.frameSize:]))
+        self.overlays = kept
+        self.overlayStarts = [first for first, last, data in kept]
+
+
+class FrameStream(object):
+    # Reads a replay front to back on its own thread, a chunk at a time, keeping at most depth encoded chunks ready
+    # ahead of whoever is sending them. Memory use doesn't depend on the size of the movie, and unlike FrameSource
+    # it works on pipes.
+
+    def __init__(self, f, customCommand, gatherMap, rawFrameSize, chunkFrames=256, depth=4, activeLow=True):
+        self.frameSize = 1 + len(gatherMap)
+        self.chunks = Queue.Queue(depth)
+        self.pending = ""  # encoded frames taken off the queue but not handed out yet
+        self.finished = False
+
+        reader = threading.Thread(target=self.readAhead,
+                                  args=(f, customCommand, gatherMap, rawFrameSize, chunkFrames, activeLow))
+        reader.daemon = True
+        reader.start()
+
+    def readAhead(self, f, customCommand, gatherMap, rawFrameSize, chunkFrames, activeLow):
+        leftover = ""  # part of a frame the last read stopped in the middle of
+        try:
+            while rawFrameSize > 0:
+                data = f.read(chunkFrames * rawFrameSize)
+                if not data:
+                    break
+                data = leftover + data
+                usable = len(data) - len(data) % rawFrameSize
+                leftover = data[usable:]
+                self.chunks.put(str(encodeFrames(data[:usable], customCommand, gatherMap, rawFrameSize, activeLow)))
+        finally:
+            self.chunks.put(None)  # end of the movie
+
+    def getFrames(self, amount):
+        # returns the commands for the next amount frames, fewer once the movie runs out. Blocks until they've been read
+        wanted = amount * self.frameSize
+        while len(self.pending) < wanted and not self.finished:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.finished = True
+            else:
+                self.pending += chunk
+        data = self.pending[:wanted]
+        self.pending = self.pending[wanted:]
+        return data
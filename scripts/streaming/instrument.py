@@ -0,0 +1,119 @@
+# Optional timing instrumentation for the serial loop. Every batch of latches a run sees is recorded as one sample in a
+# preallocated ring of doubles, so recording never grows a list or allocates a new buffer while streaming.
+#
+# Dump file layout (all little endian): the header MAGIC, version and number of rings as "<4sII", then for each ring
+# its run number and sample count as "<II" followed by count * FIELDS doubles, oldest sample first.
+
+import array
+import struct
+import sys
+
+MAGIC = 'TLLT'
+VERSION = 1
+
+# what each sample holds, in order
+FIELDS = ('latch', 'latches', 'write_start', 'write_end', 'frames_sent')
+NUM_FIELDS = len(FIELDS)
+LATCH, LATCHES, WRITE_START, WRITE_END, FRAMES_SENT = range(NUM_FIELDS)
+
+DEFAULT_CAPACITY = 65536  # samples per run, a bit over 18 minutes at 60 latches per second
+
+
+class SampleRing(object):
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.data = array.array('d', [0.0]) * (capacity * NUM_FIELDS)
+        self.next = 0  # slot the next sample goes in
+        self.count = 0
+
+    def record(self, latch, latches, writeStart, writeEnd, framesSent):
+        data = self.data
+        i = self.next * NUM_FIELDS
+        data[i] = latch
+        data[i + 1] = latches
+        data[i + 2] = writeStart
+        data[i + 3] = writeEnd
+        data[i + 4] = framesSent
+        self.next += 1
+        if self.next == self.capacity:
+            self.next = 0
+        if self.count < self.capacity:
+            self.count += 1
+
+    def clear(self):
+        self.next = 0
+        self.count = 0
+
+    def ordered(self):
+        # returns a copy of the samples as a flat array, oldest first
+        if self.count < self.capacity:
+            return self.data[:self.count * NUM_FIELDS]
+        split = self.next * NUM_FIELDS
+        return self.data[split:] + self.data[:split]
+
+    def column(self, field):
+        return self.ordered()[field::NUM_FIELDS]
+
+
+def percentile(values, fraction):
+    # nearest rank on an already sorted list
+    if not values:
+        return 0.0
+    rank = int(round(fraction * (len(values) - 1)))
+    return values[rank]
+
+
+def summarize(ring):
+    # returns a dict of latch to write latency and latch interval statistics, in milliseconds
+    samples = ring.ordered()
+    latchTimes = samples[LATCH::NUM_FIELDS]
+    latencies = sorted([(end - latch) * 1000.0 for latch, end in zip(latchTimes, samples[WRITE_END::NUM_FIELDS])])
+
+    # a batch can hold more than one latch if we fell behind, spread its interval over all of them
+    intervals = []
+    counts = samples[LATCHES::NUM_FIELDS]
+    for i in range(1, len(latchTimes)):
+        intervals.append((latchTimes[i] - latchTimes[i - 1]) * 1000.0 / max(counts[i], 1))
+    intervals.sort()
+    mean = sum(intervals) / len(intervals) if intervals else 0.0
+    deviation = (sum([(x - mean) ** 2 for x in intervals]) / len(intervals)) ** 0.5 if intervals else 0.0
+
+    return {'samples': ring.count,
+            'latches': int(sum(counts)),
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0.0,
+            'interval': percentile(intervals, 0.50),
+            'jitter': deviation,
+            'interval_min': intervals[0] if intervals else 0.0,
+            'interval_max': intervals[-1] if intervals else 0.0}
+
+
+def dump(rings, fileName):
+    # rings is a list of (run number, SampleRing)
+    with open(fileName, 'wb') as f:
+        f.write(struct.pack('<4sII', MAGIC, VERSION, len(rings)))
+        for run, ring in rings:
+            samples = ring.ordered()
+            if sys.byteorder != 'little':
+                samples.byteswap()
+            f.write(struct.pack('<II', run, ring.count))
+            samples.tofile(f)
+
+
+def load(fileName):
+    # reads a dump back in, returns a list of (run number, flat array of samples)
+    rings = []
+    with open(fileName, 'rb') as f:
+        magic, version, numRings = struct.unpack('<4sII', f.read(12))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(fileName + " is not a TASLink latency dump")
+        for _ in range(numRings):
+            run, count = struct.unpack('<II', f.read(8))
+            samples = array.array('d')
+            samples.fromfile(f, count * NUM_FIELDS)
+            if sys.byteorder != 'little':
+                samples.byteswap()
+            rings.append((run, samples))
+    return rings
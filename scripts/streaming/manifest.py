@@ -0,0 +1,145 @@
+# Run manifests: the settings of a TASRun saved as a small, versioned JSON document.
+#
+# {"format": "taslink-run", "version": 1,
+#  "run": {"numControllers": 1, "portsList": [1], "controllerType": 0, "controllerBits": 16, "overread": 0,
+#          "window": 0.0, "inputFile": "movie.r16m", "dummyFrames": 0, "dpcmFix": false, "prebuffer": 60},
+#  "movie": {"sha1": "...", "size": 1234, "mtime": 1500000000.0, "encoded": "/path/to/cache/entry.tlc"}}
+#
+# "movie" is optional and only ever a shortcut: when the movie still has the size and mtime it was saved with, its
+# hash and pre-encoded stream can be used without reading it again. Run files saved by older versions of TASLink.py
+# are YAML dumps of the TASRun object itself; those are still read, without running any code from them.
+
+import json
+import os
+import sys
+
+FORMAT = 'taslink-run'
+VERSION = 1
+
+# field: (types it can have, default or REQUIRED)
+REQUIRED = object()
+RUN_FIELDS = {
+    'numControllers': ((int,), REQUIRED),
+    'portsList': ((list,), REQUIRED),
+    'controllerType': ((int,), REQUIRED),
+    'controllerBits': ((int,), REQUIRED),
+    'overread': ((int, bool), 0),
+    'window': ((int, float), 0.0),
+    'inputFile': ((basestring,), REQUIRED),
+    'dummyFrames': ((int,), 0),
+    'dpcmFix': ((bool,), False),
+    'prebuffer': ((int,), None),
+}
+MOVIE_FIELDS = {
+    'sha1': ((basestring,), None),
+    'size': ((int, long), None),
+    'mtime': ((int, float), None),
+    'encoded': ((basestring,), None),
+}
+
+# JSON only holds unicode, strings (paths above all) get turned back into the byte strings the rest of TASLink.py uses
+PATH_ENCODING = sys.getfilesystemencoding() or 'utf-8'
+
+LEGACY_TAG = 'tag:yaml.org,2002:python/object:__main__.TASRun'
+
+
+class ManifestError(Exception):
+    pass
+
+
+def checkFields(values, fields, where):
+    if not isinstance(values, dict):
+        raise ManifestError(where + " should be an object")
+    checked = {}
+    for name, (types, default) in fields.items():
+        if name not in values or values[name] is None:
+            if default is REQUIRED:
+                raise ManifestError(where + " is missing " + name)
+            checked[name] = default
+            continue
+        value = values[name]
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise ManifestError(where + "." + name + " has the wrong type")
+        if isinstance(value, unicode):
+            try:
+                value = value.encode(PATH_ENCODING)
+            except UnicodeError:
+                raise ManifestError(where + "." + name + " can't be a path on this system")
+        checked[name] = value
+    if not all(isinstance(port, int) and 1 <= port <= 4 for port in checked.get('portsList') or []):
+        raise ManifestError(where + ".portsList should be port numbers 1-4")
+    return checked
+
+
+def parse(text, where="run file"):
+    # returns (run fields, movie fields) from either a manifest or a legacy YAML run
+    if text.lstrip().startswith('{'):
+        try:
+            document = json.loads(text)
+        except ValueError as e:
+            raise ManifestError(where + " is not valid JSON: " + str(e))
+        if not isinstance(document, dict) or document.get('format') != FORMAT:
+            raise ManifestError(where + " is not a TASLink run")
+        if document.get('version') != VERSION:
+            raise ManifestError(where + " is version " + str(document.get('version')) + ", this TASLink.py reads " +
+                                "version " + str(VERSION))
+        return checkFields(document.get('run'), RUN_FIELDS, 'run'), \
+            checkFields(document.get('movie') or {}, MOVIE_FIELDS, 'movie')
+    return checkFields(parseLegacy(text, where), RUN_FIELDS, 'run'), checkFields({}, MOVIE_FIELDS, 'movie')
+
+
+def parseLegacy(text, where):
+    import yaml  # only needed for old run files, and slow to import
+
+    class LegacyLoader(yaml.SafeLoader):
+        pass
+
+    def constructRun(loader, node):
+        return loader.construct_mapping(node, deep=True)
+
+    LegacyLoader.add_constructor(LEGACY_TAG, constructRun)
+    try:
+        values = yaml.load(text, Loader=LegacyLoader)
+    except yaml.YAMLError as e:
+        raise ManifestError(where + " is neither a run manifest nor an old YAML run: " + str(e))
+    if not isinstance(values, dict):
+        raise ManifestError(where + " is neither a run manifest nor an old YAML run")
+    return values
+
+
+def load(fileName):
+    with open(fileName, 'rb') as f:
+        return parse(f.read(), fileName)
+
+
+def movieInfo(fileName, sha1, encoded=None):
+    stat = os.stat(fileName)
+    return {'sha1': sha1, 'size': stat.st_size, 'mtime': stat.st_mtime, 'encoded': encoded}
+
+
+def movieUnchanged(fileName, movie):
+    # whether the movie still looks the way it did when the manifest was saved
+    if not movie['sha1']:
+        return False
+    try:
+        stat = os.stat(fileName)
+    except OSError:
+        return False
+    return stat.st_size == movie['size'] and stat.st_mtime == movie['mtime']
+
+
+def dumps(runFields, movie=None):
+    document = {'format': FORMAT, 'version': VERSION, 'run': runFields}
+    if movie:
+        document['movie'] = movie
+    return json.dumps(document, indent=2, sort_keys=True, separators=(',', ': '), encoding=PATH_ENCODING) + "\n"
+
+
+def save(fileName, runFields, movie=None):
+    # written next to the destination first, so a failed save never leaves half a run file behind
+    temp = fileName + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(dumps(runFields, movie))
+    if os.path.exists(fileName):
+        os.remove(fileName)  # rename won't replace a file on windows
+    os.rename(temp, fileName)
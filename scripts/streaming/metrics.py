@@ -0,0 +1,121 @@
+# Streaming telemetry in the Prometheus text exposition format, for dashboards and alerting to watch a long session
+# without going near the CLI. TASLINK_METRICS=[host:]port serves it over HTTP at /metrics (on 127.0.0.1 unless a host
+# is given), TASLINK_METRICS_FILE=<file> rewrites a file with it every few seconds for node_exporter's textfile
+# collector. Either works with TASLink.py in CLI or daemon mode.
+#
+# The serial thread owns every counter and only ever adds to them in place. When an exporter is asked for them it has
+# the serial thread copy them between latch batches, which is all the serial loop does on its behalf, so nothing takes
+# a lock and a scrape never sees half of a change.
+
+import BaseHTTPServer
+import os
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+FILE_INTERVAL = 5.0  # seconds between textfile updates
+# upper bounds in seconds for the serial loop iteration time histogram
+LOOP_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1]
+
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                           for name, value in labels]) + '}'
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(families):
+    # families is a list of (name, type, help, samples), each sample a (suffix, labels, value) with labels a list of
+    # (name, value) pairs. Returns the exposition text
+    lines = []
+    for name, kind, description, samples in families:
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            lines.append(name + suffix + formatLabels(labels) + ' ' + formatValue(value))
+    return '\n'.join(lines) + '\n'
+
+
+def histogramSamples(labels, bounds, counts, total):
+    # counts has one entry per bound plus one for everything above the last, not cumulative
+    samples = []
+    cumulative = 0
+    for bound, count in zip(bounds + [float('inf')], counts):
+        cumulative += count
+        samples.append(('_bucket', labels + [('le', formatValue(bound))], cumulative))
+    samples.append(('_sum', labels, total))
+    samples.append(('_count', labels, cumulative))
+    return samples
+
+
+def parseAddress(value):
+    # "[host:]port" -> (host, port)
+    host, _, port = value.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class MetricsServer(object):
+    # serves collect() at /metrics on a thread of its own
+
+    def __init__(self, address, collect):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = collect()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # a scrape every few seconds would bury the CLI
+
+        self.server = BaseHTTPServer.HTTPServer(address, Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsFile(object):
+    # rewrites fileName with collect() every FILE_INTERVAL seconds, through a temporary file so a reader never sees
+    # half of it
+
+    def __init__(self, fileName, collect):
+        self.fileName = fileName
+        self.collect = collect
+        self.stopped = threading.Event()
+        self.write()  # fail now rather than on the thread if the file can't be written
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self):
+        temporary = self.fileName + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.collect())
+        if os.name == 'nt' and os.path.exists(self.fileName):
+            os.remove(self.fileName)  # rename doesn't replace files on Windows
+        os.rename(temporary, self.fileName)
+
+    def run(self):
+        while not self.stopped.wait(FILE_INTERVAL):
+            try:
+                self.write()
+            except (IOError, OSError):
+                pass  # try again next time, the file may just be busy
+
+    def stop(self):
+        self.stopped.set()
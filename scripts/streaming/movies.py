@@ -0,0 +1,327 @@
+# Streaming conversion of emulator movies into the raw replay formats TASLink streams.
+#
+#   .fm2 (FCEUX, NES)            -> r08: 1 byte per controller, 2 controllers, A B Select Start Up Down Left Right
+#   .bk2 (BizHawk, NES or SNES)  -> r08, or r16m for SNES
+#   .lsmv (lsnes, SNES)          -> r16m: 2 bytes per controller, 4 controllers on each port (multitap layout),
+#                                   B Y Select Start Up Down Left Right, then A X L R 0 0 0 0
+#
+# Bits are 1 for pressed, most significant first, the same as the r08/r16m files made by other tools. Movies are read
+# a line at a time and written out a block at a time, so memory use doesn't depend on the length of the movie.
+#
+# One input line becomes one frame. Emulators record a line per frame (lsnes also per subframe) whether or not the game
+# polled its controllers, so a movie with lag frames still needs the blank frames adjusted, or a latch accurate dump
+# like ../emulator/SNES/lsnes_dump_latches.lua, which is the reference for what TASLink should be sent.
+#
+# Converted replays are kept in the run cache directory (see runcache.py) keyed by the movie's hash, so a movie is only
+# converted once.
+
+import hashlib
+import operator
+import os
+import tempfile
+import zipfile
+
+import runcache
+
+CONVERTER_VERSION = 1  # bump when the output of a converter changes, so old conversions aren't reused
+
+RAW_FORMATS = ('r08', 'r16', 'r16m')
+
+BLOCK_FRAMES = 4096  # frames written at a time
+
+# bit of each button in a controller's bytes, by the names the movie formats use
+NES_BUTTONS = {'A': 7, 'B': 6, 'Select': 5, 'Start': 4, 'Up': 3, 'Down': 2, 'Left': 1, 'Right': 0}
+SNES_BUTTONS = {'B': 15, 'Y': 14, 'Select': 13, 'Start': 12, 'Up': 11, 'Down': 10, 'Left': 9, 'Right': 8,
+                'A': 7, 'X': 6, 'L': 5, 'R': 4}
+
+FM2_PAD = ['Right', 'Left', 'Down', 'Up', 'Start', 'Select', 'B', 'A']  # the order of an fm2 gamepad field
+LSNES_PAD = ['B', 'Y', 'Select', 'Start', 'Up', 'Down', 'Left', 'Right', 'A', 'X', 'L', 'R']
+LSNES_CONTROLLERS = {'none': 0, 'gamepad': 1, 'gamepad16': 1, 'multitap': 4, 'multitap16': 4}
+
+
+class MovieError(Exception):
+    pass
+
+
+def extension(fileName):
+    return fileName.split(".")[-1].strip().lower()
+
+
+def isMovie(fileName):
+    return extension(fileName) in CONVERTERS
+
+
+class FieldDecoder(dict):
+    # maps one controller's field from an input line to its bytes. A movie only has so many distinct fields, so each
+    # one is only worked out the first time it's looked up, and after that it's a plain dict lookup.
+
+    def __init__(self, buttons, bits, numBytes):
+        dict.__init__(self)
+        self.bits = [bits[button] for button in buttons]  # bit for each character position
+        self.numBytes = numBytes
+
+    def __missing__(self, field):
+        value = 0
+        for position, bit in enumerate(self.bits):
+            if position < len(field) and field[position] not in '. ':
+                value |= 1 << bit
+        encoded = ''.join([chr((value >> (8 * i)) & 0xFF) for i in reversed(range(self.numBytes))])
+        self[field] = encoded
+        return encoded
+
+
+def framesFromLines(lines, decode, layout, empty, isInput):
+    # layout lists the field on a line that goes in each controller slot of a frame. Field number empty is always
+    # made empty, for slots with no controller to point at.
+    pick = operator.itemgetter(*layout)
+    lookup = decode.__getitem__
+    for line in lines:
+        if not isInput(line):
+            continue
+        fields = line.split('|')
+        if len(fields) <= empty:
+            fields += [''] * (empty + 1 - len(fields))
+        fields[empty] = ''
+        yield ''.join(map(lookup, pick(fields)))
+
+
+def readLines(f, blockSize=1024 * 1024):
+    # iterating over a file line by line is slow for files inside zips, so read big blocks and split them ourselves
+    rest = ''
+    while True:
+        block = f.read(blockSize)
+        if not block:
+            break
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def writeFrames(frames, out):
+    # frames yields one raw frame string at a time
+    block = []
+    count = 0
+    for frame in frames:
+        block.append(frame)
+        if len(block) == BLOCK_FRAMES:
+            out.write(''.join(block))
+            count += len(block)
+            del block[:]
+    out.write(''.join(block))
+    return count + len(block)
+
+
+def readFm2(fileName):
+    # returns the replay format and a generator of its frames
+    header = {}
+    with open(fileName, 'rb') as f:
+        for line in f:
+            if line.startswith('|'):
+                break
+            words = line.strip().split(' ', 1)
+            if words[0]:
+                header[words[0]] = words[1] if len(words) > 1 else ''
+    if header.get('binary', '0') != '0':
+        raise MovieError("binary fm2 input logs aren't supported")
+    if header.get('fourscore', '0') != '0':
+        raise MovieError("four score fm2 movies have more controllers than r08 can hold")
+    for port in ('port0', 'port1'):
+        if header.get(port, '1') not in ('0', '1'):  # SI_NONE, SI_GAMEPAD
+            raise MovieError("fm2 " + port + " isn't a gamepad")
+
+    def frames():
+        # '', commands, port0, port1, port2, ...
+        with open(fileName, 'rb') as f:
+            for frame in framesFromLines(readLines(f), FieldDecoder(FM2_PAD, NES_BUTTONS, 1), [2, 3], 4,
+                                         lambda line: line.startswith('|')):
+                yield frame
+
+    return 'r08', frames()
+
+
+def bk2Platform(archive, names):
+    if 'header.txt' in names:
+        for line in archive.read(names['header.txt']).splitlines():
+            words = line.strip().split(' ', 1)
+            if words[0].lower() == 'platform' and len(words) > 1:
+                return words[1].strip().upper()
+    return ''
+
+
+def readBk2(fileName):
+    archive = zipfile.ZipFile(fileName)
+    names = dict((name.lower(), name) for name in archive.namelist())
+    if 'input log.txt' not in names:
+        raise MovieError("bk2 has no Input Log.txt")
+
+    platform = bk2Platform(archive, names)
+    # controller slots in the replay frame, and which of them the players go in
+    if platform == 'NES':
+        replay, bits, numBytes, slots, playerSlots = 'r08', NES_BUTTONS, 1, 2, [0, 1]
+    elif platform == 'SNES':
+        replay, bits, numBytes, slots, playerSlots = 'r16m', SNES_BUTTONS, 2, 8, [0, 4]
+    else:
+        raise MovieError("bk2 platform " + (platform or "(missing)") + " isn't supported, only NES and SNES")
+
+    # the LogKey line names every column: #Reset|Power|#P1 Up|P1 Down|...|#P2 Up|...
+    log = archive.open(names['input log.txt'])
+    groups = None
+    for line in log:
+        if line.startswith('LogKey:'):
+            groups = [group.rstrip('|').split('|') for group in line.strip()[len('LogKey:'):].split('#') if group]
+            break
+        if line.startswith('|'):
+            break
+    if groups is None:
+        raise MovieError("bk2 input log has no LogKey")
+
+    players = []  # LogKey group of each player, in player order
+    buttons = None
+    for index, group in enumerate(groups):
+        player = group[0].split(' ', 1)[0]
+        if not (player.startswith('P') and player[1:].isdigit()):
+            continue  # console buttons, like Reset and Power
+        playerButtons = [name.split(' ', 1)[1] if ' ' in name else name for name in group]
+        unknown = [button for button in playerButtons if button not in bits]
+        if unknown:
+            raise MovieError("bk2 " + player + " has inputs we can't send: " + ', '.join(unknown))
+        if buttons is not None and playerButtons != buttons:
+            raise MovieError("bk2 players have different controllers")
+        buttons = playerButtons
+        players.append(index + 1)  # the input line starts with a | too
+    if len(players) > len(playerSlots):
+        raise MovieError("bk2 has " + str(len(players)) + " players, only " + str(len(playerSlots)) + " are supported")
+
+    # which field of an input line fills each slot, slots without a player get the empty one
+    layout = [len(groups) + 1] * slots
+    for field, slot in zip(players, playerSlots):
+        layout[slot] = field
+    decode = FieldDecoder(buttons or [], bits, numBytes)
+
+    def frames():
+        try:
+            for frame in framesFromLines(readLines(log), decode, layout, len(groups) + 1,
+                                         lambda line: line.startswith('|')):
+                yield frame
+        finally:
+            log.close()
+            archive.close()
+
+    return replay, frames()
+
+
+def readLsmv(fileName):
+    archive = zipfile.ZipFile(fileName)
+    names = archive.namelist()
+    if 'input' not in names:
+        raise MovieError("lsmv has no input")
+
+    def member(name, default):
+        if name in names:
+            return archive.read(name).strip() or default
+        return default
+
+    gametype = member('gametype', 'snes_ntsc')
+    if not gametype.startswith('snes') and not gametype.startswith('bsx') and not gametype.startswith('sgb'):
+        raise MovieError("lsmv game type " + gametype + " isn't supported, only SNES")
+
+    # which field on an input line fills each of the 8 controller slots in an r16m frame. The first field is the
+    # system's (frame sync and reset), then come the controllers of port 1 and port 2. Slots with no controller get
+    # the empty one.
+    layout = []
+    field = 1
+    for port, default in ((0, 'gamepad'), (1, 'none')):
+        kind = member('port' + str(port + 1), default)
+        if kind not in LSNES_CONTROLLERS:
+            raise MovieError("lsmv port " + str(port + 1) + " has a " + kind + ", which we can't send")
+        count = LSNES_CONTROLLERS[kind]
+        layout += range(field, field + count) + [None] * (4 - count)
+        field += count
+    layout = [field if index is None else index for index in layout]
+
+    def frames():
+        log = archive.open('input')
+        try:
+            for frame in framesFromLines(readLines(log), FieldDecoder(LSNES_PAD, SNES_BUTTONS, 2), layout, field,
+                                         lambda line: line.strip()):
+                yield frame
+        finally:
+            log.close()
+            archive.close()
+
+    return 'r16m', frames()
+
+
+CONVERTERS = {'fm2': readFm2, 'bk2': readBk2, 'lsmv': readLsmv}
+
+
+def replayType(fileName):
+    # the raw format a file gets streamed as, without converting anything
+    kind = extension(fileName)
+    if kind == 'bk2':
+        try:
+            archive = zipfile.ZipFile(fileName)
+            with archive:
+                platform = bk2Platform(archive, dict((name.lower(), name) for name in archive.namelist()))
+            return 'r08' if platform == 'NES' else 'r16m'
+        except (IOError, zipfile.BadZipfile):
+            return kind
+    if kind in CONVERTERS:
+        return 'r08' if kind == 'fm2' else 'r16m'
+    return kind
+
+
+def convert(fileName, outName):
+    # converts a movie to its raw format, returns the format and number of frames
+    try:
+        replay, frames = CONVERTERS[extension(fileName)](fileName)
+        with open(outName, 'wb') as out:
+            return replay, writeFrames(frames, out)
+    except zipfile.BadZipfile:
+        raise MovieError(fileName + " is not a valid " + extension(fileName) + " file")
+
+
+def replayFile(fileName):
+    # returns a raw replay for fileName, converting a movie the first time it's asked for and reusing that afterwards
+    if not isMovie(fileName):
+        return fileName
+    key = hashlib.sha1("%s:%d" % (runcache.fileHash(fileName), CONVERTER_VERSION)).hexdigest()
+    path = os.path.join(runcache.CACHE_DIR, key + '.' + replayType(fileName))
+    if os.path.isfile(path):
+        os.utime(path, None)  # mark it as recently used
+        return path
+
+    if not os.path.isdir(runcache.CACHE_DIR):
+        os.makedirs(runcache.CACHE_DIR)
+    fd, tempName = tempfile.mkstemp(suffix='.tmp', dir=runcache.CACHE_DIR)
+    os.close(fd)
+    try:
+        convert(fileName, tempName)
+        os.rename(tempName, path)
+    finally:
+        if os.path.exists(tempName):
+            os.remove(tempName)
+    runcache.evict(path)
+    return path
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    if len(sys.argv) < 2:
+        sys.stderr.write('Usage: ' + sys.argv[0] + ' <movie> [output]\n\n')
+        sys.exit(0)
+    start = time.time()
+    try:
+        if len(sys.argv) > 2:
+            replay, count = convert(sys.argv[1], sys.argv[2])
+            print("Wrote %d %s frames to %s in %.2fs" % (count, replay, sys.argv[2], time.time() - start))
+        else:
+            print("%s (%.2fs)" % (replayFile(sys.argv[1]), time.time() - start))
+    except (IOError, MovieError) as e:
+        sys.stderr.write('Error: ' + str(e) + '\n')
+        sys.exit(1)
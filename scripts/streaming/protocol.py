@@ -0,0 +1,104 @@
+# TASLink's UART commands (see HDL/TASLink/main.vhd), encoded from plain parameters into the bytes the board expects.
+#
+# Every command is a string built out of tables made once at import, so there's no formatting or bit twiddling per
+# call. Commands are meant to be concatenated: a whole setup transaction goes out as one write, and so as one USB
+# transfer, rather than a write per command.
+
+NUM_PORTS = 4
+NUM_LANES = 8
+FIFO_DEPTH = 64  # entries in a lane's fifo, see fifo.vhd (the N64 board's HDL/N64/fifo.vhd is as deep)
+FIFO_CAPACITY = FIFO_DEPTH - 1  # frames a lane can hold, the head never catches up to the tail so one is always empty
+
+WINDOW_STEP = 0.25  # ms per step of the event window
+MAX_WINDOW_STEPS = 63
+
+# port configurations for 'sp'
+SR_CONTROLLER = 0x00
+Y_CABLE = 0x01
+MULTITAP_2P = 0x02
+MULTITAP_5P = 0x03
+FOUR_SCORE = 0xFF
+CLOCK_DELAY = 0x80
+
+CONNECTED = 0x80  # 'sc' byte
+OVERREAD = 0x40
+SIZE_BITS = {8: 0x00, 16: 0x01, 24: 0x02, 32: 0x03}  # bytes per frame, less one
+
+EVENT_ENABLED = 0x80  # 'se' byte
+EVENT_RESTART = 0x40
+
+CLEAR_ALL = 'R'  # empty every lane
+HOLD_CONSOLE = 'sd1'  # hold the consoles in reset
+RELEASE_CONSOLE = 'sd0'
+
+BYTES = [chr(x) for x in range(256)]
+LANE_BITS = [0] + [1 << (lane - 1) for lane in range(1, NUM_LANES + 1)]
+CONTROLLER_PREFIX = [None] + ['sc' + str(lane) for lane in range(1, NUM_LANES + 1)]
+PORT_PREFIX = [None] + ['sp' + str(port) for port in range(1, NUM_PORTS + 1)]
+EVENT_PREFIX = [None] + ['se' + str(port) for port in range(1, NUM_PORTS + 1)]
+CLEAR_LANES = ['r' + BYTES[mask] for mask in range(256)]
+EVENTS_OFF = ''.join([prefix + BYTES[0] + BYTES[0] for prefix in EVENT_PREFIX[1:]])
+
+
+def laneMask(laneNumbers):
+    mask = 0
+    for lane in laneNumbers:
+        mask |= LANE_BITS[lane]
+    return mask
+
+
+def controllerSetup(lane, bits, overread=False, connected=True):
+    # 'sc': what's plugged into a lane and how many bits a frame has
+    return CONTROLLER_PREFIX[lane] + BYTES[(CONNECTED if connected else 0) | (OVERREAD if overread else 0) |
+                                           SIZE_BITS[bits]]
+
+
+def portSetup(port, config, clockDelay=False):
+    # 'sp': what's plugged into a console port
+    return PORT_PREFIX[port] + BYTES[config | (CLOCK_DELAY if clockDelay else 0)]
+
+
+def streamSetup(letter, mask):
+    # 'sA' to 'sD': which lanes a custom stream command fills
+    return 's' + letter + BYTES[mask]
+
+
+def windowSteps(window):
+    # window in ms, anything past what the byte can hold is cut down to the longest window rather than spilling into
+    # the flags
+    return min(max(int(window / WINDOW_STEP), 0), MAX_WINDOW_STEPS)
+
+
+def eventSetup(port, mask, window=0.0, enabled=True, restart=False):
+    # 'se': which lanes a latch on the port takes a frame from, and the window that merges latches into one event
+    return EVENT_PREFIX[port] + BYTES[(EVENT_ENABLED if enabled else 0) | (EVENT_RESTART if restart else 0) |
+                                      windowSteps(window)] + BYTES[mask]
+
+
+def eventsOff():
+    return EVENTS_OFF
+
+
+def clearLanes(mask):
+    # 'r': empty the lanes in mask
+    return CLEAR_LANES[mask]
+
+
+COMMAND_LENGTHS = {'sc': 4, 'sp': 4, 'se': 5, 'sd': 3}
+
+
+def describe(data):
+    # the commands in data as readable text, for when there's no board to send them to
+    described = []
+    i = 0
+    while i < len(data):
+        if data[i] == 's':
+            length = COMMAND_LENGTHS.get(data[i:i + 2], 3)
+            name = 2 if length == 3 and data[i + 1] != 'd' else 3  # 'sc1', 'sp1', 'se1' and 'sd1' end in a digit
+        else:
+            length = 2 if data[i] == 'r' else 1
+            name = 1
+        command = data[i:i + length]
+        described.append(command[:name] + ''.join([' {0:08b}'.format(ord(b)) for b in command[name:]]))
+        i += length
+    return ', '.join(described)
@@ -0,0 +1,262 @@
+# Serial session recorder. Wraps the serial port and logs every byte that crosses it in either direction, with the
+# monotonic time it went past, so a session that went wrong on real hardware can be looked at and replayed afterwards.
+# Set TASLINK_RECORD to a log file to record TASLink.py, stream_NES.py or stream_N64.py.
+#
+# Log layout (all little endian): MAGIC and VERSION as "<4sI" at the start of the file, then records appended back to
+# back, each "<dBI" (time in seconds, direction, length) followed by that many bytes. The direction is SENT (host to
+# board), RECEIVED (board to host) or SESSION, which starts a new session and holds the wall clock time and command
+# line it was recorded with. A log can hold any number of sessions. Writes are buffered and flushed about once a
+# second, a record cut off by a crash is ignored when reading.
+#
+# python recorder.py dump <log> lists what's in a log. python recorder.py replay <log> plays the board's side of a
+# session back on a pty, at the original or a faster speed, for the same script and runs to be streamed against. It
+# reports where the host's output stops matching the recording and how quickly it answered compared to the original.
+
+import argparse
+import atexit
+import os
+import select
+import struct
+import sys
+import time
+
+import instrument
+from clock import monotonic
+
+MAGIC = 'TLSR'
+VERSION = 1
+HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<dBI')
+
+SENT = 0
+RECEIVED = 1
+SESSION = 2
+DIRECTIONS = {SENT: 'sent', RECEIVED: 'received', SESSION: 'session'}
+
+FLUSH_INTERVAL = 1.0  # seconds
+
+
+class RecordingSerial(object):
+    # Stands in for a serial.Serial, everything it doesn't handle itself goes straight to the real port. Only ever
+    # used from one thread at a time, like the port itself.
+
+    def __init__(self, ser, fileName):
+        self.ser = ser
+        new = not os.path.exists(fileName) or os.path.getsize(fileName) == 0
+        if not new:
+            with open(fileName, 'rb') as f:
+                if HEADER.unpack(f.read(HEADER.size).ljust(HEADER.size, '\0')) != (MAGIC, VERSION):
+                    raise ValueError(fileName + " is not a TASLink session log")
+        self.log = open(fileName, 'ab', 1 << 16)
+        if new:
+            self.log.write(HEADER.pack(MAGIC, VERSION))
+        self.lastFlush = monotonic()
+        self.record(SESSION, time.strftime('%Y-%m-%dT%H:%M:%S') + " " + " ".join(sys.argv))
+        atexit.register(self.flush)  # scripts that stream until Ctrl-C never close the port
+
+    def record(self, direction, data):
+        now = monotonic()
+        self.log.write(RECORD.pack(now, direction, len(data)) + data)
+        if now - self.lastFlush >= FLUSH_INTERVAL:
+            self.log.flush()
+            self.lastFlush = now
+
+    def flush(self):
+        if not self.log.closed:
+            self.log.flush()
+
+    def write(self, data):
+        # logged once it's on its way, so recording never holds up the frames
+        result = self.ser.write(data)
+        self.record(SENT, data)
+        return result
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self.record(RECEIVED, data)
+        return data
+
+    def close(self):
+        self.ser.close()
+        self.log.close()
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+
+def readLog(fileName):
+    # yields (time, direction, data) for every complete record
+    with open(fileName, 'rb') as f:
+        if HEADER.unpack(f.read(HEADER.size).ljust(HEADER.size, '\0')) != (MAGIC, VERSION):
+            raise ValueError(fileName + " is not a TASLink session log")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            when, direction, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield when, direction, data
+
+
+def readSessions(fileName):
+    # returns a list of sessions, each a (description, records) pair
+    sessions = []
+    for when, direction, data in readLog(fileName):
+        if direction == SESSION:
+            sessions.append((data, []))
+        elif sessions:
+            sessions[-1][1].append((when, direction, data))
+    return sessions
+
+
+def dump(sessions, number, verbose):
+    for index, (description, records) in enumerate(sessions):
+        if number is not None and index + 1 != number:
+            continue
+        sent = sum([len(data) for when, direction, data in records if direction == SENT])
+        received = sum([len(data) for when, direction, data in records if direction == RECEIVED])
+        length = records[-1][0] - records[0][0] if records else 0.0
+        print("Session %d: %s" % (index + 1, description))
+        print("  %.3fs, %d records, %d bytes sent, %d bytes received" % (length, len(records), sent, received))
+        if verbose:
+            for when, direction, data in records:
+                print("  %12.6f %-8s %s" % (when - records[0][0], DIRECTIONS[direction], data.encode('hex')))
+
+
+def replay(records, master, speed):
+    # plays the board's side of records back on master and checks what the host sends against the recording.
+    # The clock starts once the host has sent everything it sent before the board first spoke (the setup and the
+    # prebuffer), from then on the board speaks at the recorded times, divided by speed.
+    expected = ''.join([data for when, direction, data in records if direction == SENT])
+    events = []  # (recorded time, data, host bytes sent before it, recorded time the host answered or None)
+    sentSoFar = 0
+    unanswered = 0
+    for when, direction, data in records:
+        if direction == SENT:
+            for event in events[unanswered:]:
+                event[3] = when
+            unanswered = len(events)
+            sentSoFar += len(data)
+        else:
+            events.append([when, data, sentSoFar, None])
+
+    received = []
+    receivedBytes = 0
+    mismatch = None
+    pending = []  # (index of the event, replay time it was sent) for events waiting on an answer
+    recordedLatency = []
+    replayLatency = []
+    start = None
+    nextEvent = 0
+    lastActivity = monotonic()
+
+    while True:
+        now = monotonic()
+        if start is None and events and receivedBytes >= events[0][2]:
+            start = now
+        if start is not None:
+            while nextEvent < len(events) and start + (events[nextEvent][0] - events[0][0]) / speed <= now:
+                os.write(master, events[nextEvent][1])
+                pending.append((nextEvent, now))
+                nextEvent += 1
+
+        if nextEvent == len(events) and (receivedBytes >= len(expected) or now - lastActivity > 2.0):
+            break
+        if not events and now - lastActivity > 2.0:
+            break
+
+        timeout = 0.5
+        if start is not None and nextEvent < len(events):
+            timeout = max(0.0, min(timeout, start + (events[nextEvent][0] - events[0][0]) / speed - now))
+        if not select.select([master], [], [], timeout)[0]:
+            continue
+        try:
+            data = os.read(master, 65536)
+        except OSError:
+            data = ''  # host has the port closed at the moment
+        if not data:
+            time.sleep(0.01)
+            continue
+        now = monotonic()
+        lastActivity = now
+        if mismatch is None and data != expected[receivedBytes:receivedBytes + len(data)]:
+            for offset in range(len(data)):
+                if receivedBytes + offset >= len(expected) or data[offset] != expected[receivedBytes + offset]:
+                    mismatch = receivedBytes + offset
+                    break
+        received.append(data)
+        receivedBytes += len(data)
+        # the first bytes the host sends after an event are its answer to it
+        for index, sentAt in pending:
+            event = events[index]
+            replayLatency.append(now - sentAt)
+            if event[3] is not None:
+                recordedLatency.append(event[3] - event[0])
+        pending = []
+
+    return {'expected': len(expected), 'received': receivedBytes, 'mismatch': mismatch, 'events': nextEvent,
+            'recorded': recordedLatency, 'replayed': replayLatency, 'sent': ''.join(received), 'wanted': expected}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look at or replay serial sessions recorded with TASLINK_RECORD.")
+    parser.add_argument('action', choices=['dump', 'replay'])
+    parser.add_argument('log')
+    parser.add_argument('--session', type=int, help="which session (default: all for dump, the last for replay)")
+    parser.add_argument('--verbose', action='store_true', help="dump: list every record")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay: how much faster than recorded (default 1)")
+    parser.add_argument('--link', help="replay: also make a symlink to the pty at this path")
+    args = parser.parse_args()
+
+    sessions = readSessions(args.log)
+    if not sessions:
+        print("No sessions in " + args.log)
+        sys.exit(1)
+    if args.action == 'dump':
+        dump(sessions, args.session, args.verbose)
+        return
+
+    import board_emulator
+    number = args.session or len(sessions)
+    if not 1 <= number <= len(sessions):
+        print("There is no session %d in %s" % (number, args.log))
+        sys.exit(1)
+    description, records = sessions[number - 1]
+    master, slave, name = board_emulator.openPty(args.link)
+    print("Replaying session %d (%s) at %gx on %s%s" % (number, description, args.speed, name,
+                                                     " (" + args.link + ")" if args.link else ""))
+    print("Start the same script with the same runs on it now.")
+    sys.stdout.flush()
+    try:
+        result = replay(records, master, args.speed)
+    except KeyboardInterrupt:
+        return
+    finally:
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
+        os.close(master)
+        os.close(slave)
+
+    print("%d of %d board events played, host sent %d of %d recorded bytes" % (
+        result['events'], len([r for r in records if r[1] == RECEIVED]), result['received'], result['expected']))
+    if result['mismatch'] is None:
+        print("Everything the host sent matched the recording.")
+    else:
+        offset = result['mismatch']
+        print("Host output first differs at byte %d: recorded %s, got %s" % (
+            offset, result['wanted'][offset:offset + 16].encode('hex'), result['sent'][offset:offset + 16].encode('hex')))
+    # the recording only saw the host's side, so its answer times leave out the trip over the port
+    for label, values in (("recorded, read to write", result['recorded']),
+                          ("replayed, event to frames", result['replayed'])):
+        if values:
+            values = sorted(values)
+            print("  answer time (%s): p50 %.3fms  p99 %.3fms  max %.3fms" % (
+                label, instrument.percentile(values, 0.5) * 1e3, instrument.percentile(values, 0.99) * 1e3,
+                values[-1] * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,17 @@ import serial
 import sys
 from serial import SerialException
 
+import control
+
 baud = 2000000
 
 if len(sys.argv) < 2:
-    sys.stderr.write('Usage: ' + sys.argv[0] + ' <interface>\n\n')
+    sys.stderr.write('Usage: ' + sys.argv[0] + ' <interface or TASLink.py control socket>\n\n')
+    sys.exit(0)
+
+if control.isSocket(sys.argv[1]):  # TASLink.py is running as a daemon and already has the port
+    print(control.request(sys.argv[1], "off"))
+    print(control.request(sys.argv[1], "on"))
     sys.exit(0)
 
 try:
@@ -0,0 +1,199 @@
+# On-disk cache of encoded command streams, so reloading a run we've seen before is just mapping a file.
+#
+# An entry is keyed by the sha1 of the replay file plus everything that decides how it gets encoded (custom command,
+# raw frame size and gather map). It holds a small header followed by the movie's frames exactly as frames.encodeFrames() builds
+# them, back to back, so a range of frames is a single slice of the mapped file. The cache is kept under a size limit
+# by throwing away the least recently used entries.
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+import frames
+
+MAGIC = 'TLRC'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')  # magic, version, bytes per frame, number of frames
+EXTENSION = '.tlc'
+
+CACHE_DIR = os.environ.get('TASLINK_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.taslink', 'cache'))
+CACHE_LIMIT = int(os.environ.get('TASLINK_CACHE_SIZE', 256 * 1024 * 1024))  # bytes
+
+CHUNK_FRAMES = 65536  # frames encoded per write while building an entry
+
+HASH_INDEX = 'hashes.txt'  # remembers file hashes between sessions, one "sha1 size mtime path" per line
+hashes = None  # (path, size, mtime): sha1
+
+
+def loadHashes():
+    global hashes
+    hashes = {}
+    try:
+        with open(os.path.join(CACHE_DIR, HASH_INDEX), 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split(' ', 3)
+                if len(fields) == 4:
+                    hashes[(fields[3], int(fields[1]), fields[2])] = fields[0]
+    except (IOError, ValueError):
+        pass
+
+    # forget files that have since changed or gone away, so the index doesn't grow forever
+    stale = []
+    for key in hashes:
+        try:
+            stat = os.stat(key[0])
+            if (stat.st_size, repr(stat.st_mtime)) != key[1:]:
+                stale.append(key)
+        except OSError:
+            stale.append(key)
+    if stale:
+        for key in stale:
+            del hashes[key]
+        try:
+            with open(os.path.join(CACHE_DIR, HASH_INDEX), 'w') as f:
+                for key, digest in hashes.items():
+                    f.write("%s %d %s %s\n" % (digest, key[1], key[2], key[0]))
+        except IOError:
+            pass
+
+
+def hashKey(fileName):
+    if hashes is None:
+        loadHashes()
+    stat = os.stat(fileName)
+    return (os.path.realpath(fileName), stat.st_size, repr(stat.st_mtime))
+
+
+def rememberHash(key, digest):
+    hashes[key] = digest
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    with open(os.path.join(CACHE_DIR, HASH_INDEX), 'a') as f:
+        f.write("%s %d %s %s\n" % (digest, key[1], key[2], key[0]))
+
+
+def fileHash(fileName):
+    # a file that still has the same size and modification time isn't hashed again
+    key = hashKey(fileName)
+    if key not in hashes:
+        digest = hashlib.sha1()
+        with open(fileName, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                digest.update(chunk)
+        rememberHash(key, digest.hexdigest())
+    return hashes[key]
+
+
+def knownHash(fileName, digest):
+    # for when something else already vouches for a file's hash, like a run manifest saved alongside it
+    try:
+        key = hashKey(fileName)
+        if key not in hashes:
+            rememberHash(key, digest)
+    except (IOError, OSError):
+        pass
+
+
+def entryPath(fileName, customCommand, gatherMap, rawFrameSize):
+    params = "%s:%s:%d:%s" % (fileHash(fileName), customCommand, rawFrameSize,
+                              ','.join([str(offset) for offset in gatherMap]))
+    return os.path.join(CACHE_DIR, hashlib.sha1(params).hexdigest() + EXTENSION)
+
+
+def openEntry(path, customCommand, frameSize, movieFrames):
+    # returns the mapped entry, or None if it's missing, doesn't look right or was built for another command
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size:
+            return None
+        magic, version, entryFrameSize, numFrames = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or entryFrameSize != frameSize or numFrames != movieFrames or \
+                size != HEADER.size + numFrames * frameSize:
+            return None
+        if numFrames > 0 and f.read(1) != customCommand:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def buildEntry(path, fileName, customCommand, gatherMap, rawFrameSize):
+    frameSize = 1 + len(gatherMap)
+    with open(fileName, 'rb') as f:
+        numFrames = os.fstat(f.fileno()).st_size // rawFrameSize
+        fd, tempName = tempfile.mkstemp(suffix='.tmp', dir=CACHE_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(HEADER.pack(MAGIC, VERSION, frameSize, numFrames))
+                for _ in range(0, numFrames, CHUNK_FRAMES):
+                    out.write(frames.encodeFrames(f.read(CHUNK_FRAMES * rawFrameSize), customCommand, gatherMap,
+                                                  rawFrameSize))
+            if os.path.exists(path):
+                os.remove(path)  # rename won't replace a file on windows
+            os.rename(tempName, path)
+        except:
+            if os.path.exists(tempName):
+                os.remove(tempName)
+            raise
+
+
+def evict(keep):
+    # drop the least recently used entries (and converted movies, see movies.py) until the cache fits in its limit again
+    entries = []
+    total = 0
+    for name in os.listdir(CACHE_DIR):
+        if name == HASH_INDEX or name.endswith('.tmp'):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= CACHE_LIMIT:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass  # still mapped by someone on windows, try again next time
+
+
+def load(fileName, customCommand, gatherMap, rawFrameSize, entry=None):
+    # returns the run's encoded frames straight out of the mapped entry, or None if there's nothing to cache or the
+    # cache can't be used. Each custom command has its own entry, so the frames come with customCommand already in
+    # them. entry is where a run manifest says this movie's entry was, which is tried first.
+    if rawFrameSize <= 0 or os.path.getsize(fileName) < rawFrameSize:
+        return None
+    frameSize = 1 + len(gatherMap)
+    movieFrames = os.path.getsize(fileName) // rawFrameSize
+    try:
+        if entry:
+            data = openEntry(entry, customCommand, frameSize, movieFrames)
+            if data is not None:
+                return buffer(data, HEADER.size)
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        path = entryPath(fileName, customCommand, gatherMap, rawFrameSize)
+        data = openEntry(path, customCommand, frameSize, movieFrames)
+        if data is None:
+            buildEntry(path, fileName, customCommand, gatherMap, rawFrameSize)
+            data = openEntry(path, customCommand, frameSize, movieFrames)
+            evict(path)
+        else:
+            os.utime(path, None)  # mark it as recently used
+        if data is None:
+            return None
+        return buffer(data, HEADER.size)  # the buffer keeps the mapping alive
+    except (IOError, OSError) as e:
+        print("WARNING: run cache unavailable (" + str(e) + "), encoding frames as they're sent instead")
+        return None
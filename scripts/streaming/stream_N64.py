@@ -0,0 +1,114 @@
+import os
+import serial
+import struct
+import sys
+
+import frames
+import protocol
+import recorder
+
+baud = 2000000
+
+prebuffer = 60
+controller = 1
+
+# .m64 movies: a 0x200 byte header for versions 1 and 2, 0x400 from version 3 on, then 4 bytes per controller per
+# input poll. The 4 bytes are already in the order the console reads them (A B Z Start Up Down Left Right, then
+# reset 0 L R C-Up C-Down C-Left C-Right, then stick X, stick Y), and unlike the NES/SNES they are active high.
+M64_SIGNATURE = 'M64\x1a'
+
+framesSent = 0
+fifoLevel = 0  # frames the board should still be holding
+polls = 0
+underruns = 0
+
+if len(sys.argv) < 3:
+  sys.stderr.write('Usage: ' + sys.argv[0] + ' <interface> <m64 file or - for stdin> [prebuffer] [controller]\n\n')
+  sys.exit(0)
+
+if len(sys.argv) > 3:
+  prebuffer = min(max(int(sys.argv[3]), 1), protocol.FIFO_CAPACITY)
+
+if len(sys.argv) > 4:
+  controller = int(sys.argv[4])
+
+if sys.argv[2] == '-':
+  replay = sys.stdin
+  if sys.platform == 'win32':
+    import msvcrt
+    msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+elif os.path.exists(sys.argv[2]):
+  replay = open(sys.argv[2], 'rb')
+else:
+  sys.stderr.write('Error: "' + sys.argv[2] + '" not found\n')
+  sys.exit(1)
+
+header = replay.read(0x200)
+if len(header) < 0x200 or header[0:4] != M64_SIGNATURE:
+  sys.stderr.write('Error: "' + sys.argv[2] + '" is not an m64 movie\n')
+  sys.exit(1)
+version = struct.unpack('<I', header[4:8])[0]
+if version >= 3:
+  header += replay.read(0x200)
+numControllers = max(ord(header[0x15]), 1)
+if not 1 <= controller <= numControllers:
+  sys.stderr.write('Error: the movie only has ' + str(numControllers) + ' controller(s)\n')
+  sys.exit(1)
+
+# the board shifts a frame's 4 bytes in from the bottom and sends the top one to the console first, so they go over
+# the serial line back to front
+base = (controller - 1) * 4
+buffer1 = frames.FrameStream(replay, 'f', [base + 3, base + 2, base + 1, base], numControllers * 4, activeLow=False)
+
+
+ser = serial.Serial(sys.argv[1], baud)
+if os.environ.get('TASLINK_RECORD'):  # log everything that crosses the serial port, see recorder.py
+  ser = recorder.RecordingSerial(ser, os.environ['TASLINK_RECORD'])
+
+ser.write("R")
+
+
+def send_frames1(amount):
+  global framesSent, fifoLevel
+  data = buffer1.getFrames(amount)
+  if data:
+    ser.write(data)
+  sent = len(data) // buffer1.frameSize
+  framesSent = framesSent + sent
+  fifoLevel = fifoLevel + sent
+
+
+def summary():
+  return "%d polls, %d frames sent, %d underruns" % (polls, framesSent, underruns)
+
+
+send_frames1(prebuffer)
+
+try:
+  while (1):
+    # blocks until the board sends something, then takes everything else that's already arrived with it
+    c = ser.read()
+    waiting = ser.inWaiting()
+    if waiting:
+      c += ser.read(waiting)
+
+    count = c.count('f')
+    for other in c.replace('f', ''):
+      print ord(other)
+
+    # every 'f' is a poll that took a frame, or found the fifo empty and repeated the last one
+    polls = polls + count
+    if count > fifoLevel:
+      underruns = underruns + count - fifoLevel
+      fifoLevel = 0
+    else:
+      fifoLevel = fifoLevel - count
+
+    if count:
+      send_frames1(prebuffer - fifoLevel)
+
+    if buffer1.finished and fifoLevel == 0 and not buffer1.pending:
+      print "Movie finished: " + summary()
+      break
+except KeyboardInterrupt:
+  print summary()
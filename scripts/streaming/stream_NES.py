@@ -3,86 +3,61 @@ import serial
 import sys
 import time
 
+import frames
+import protocol
+import recorder
+
 baud = 2000000
 
 prebuffer = 60
 framecount1 = 0
 
 if len(sys.argv) < 3:
-  sys.stderr.write('Usage: ' + sys.argv[0] + ' <interface> <replayfile>\n\n')
+  sys.stderr.write('Usage: ' + sys.argv[0] + ' <interface> <replayfile or - for stdin> [prebuffer]\n\n')
   sys.exit(0)
 
-if not os.path.exists(sys.argv[2]):
+if len(sys.argv) > 3:
+  prebuffer = min(max(int(sys.argv[3]), 1), protocol.FIFO_CAPACITY)
+
+if sys.argv[2] == '-':
+  replay = sys.stdin
+  if sys.platform == 'win32':
+    import msvcrt
+    msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+elif os.path.exists(sys.argv[2]):
+  replay = open(sys.argv[2], 'rb')
+else:
   sys.stderr.write('Error: "' + sys.argv[2] + '" not found\n')
   sys.exit(1)
 
-# open the file 
-fh = open(sys.argv[2], 'rb')
-
-# load all data and store in a buffer
-buffer1 = []
-
-count = 0
-working_string = ""
-while True:
-  if (count == 0):
-    working_string = "A"
-  
-  b = fh.read(1)
-
-  if (len(b) == 0):
-    break
-  
-  b = chr(~ord(b) & 0xFF)
-  working_string = working_string + b
-  
-  count = count + 1
-  if (count == 2):
-    working_string = working_string[0:5] 
-    buffer1.append(working_string)
-    count = 0
- 
-fh.close()
+# the file is read and encoded a chunk at a time, a little ahead of what's been sent
+buffer1 = frames.FrameStream(replay, 'A', [0, 1], 2)
 
  
 ser = serial.Serial(sys.argv[1], baud)
-
-ser.write("sc1" + chr(0xD0))
-ser.write("sc2" + chr(0x00))
-ser.write("sc3" + chr(0xD0))
-ser.write("sc4" + chr(0x00))
-ser.write("sc5" + chr(0x00))
-ser.write("sc6" + chr(0x00))
-ser.write("sc7" + chr(0x00))
-ser.write("sc8" + chr(0x00))
-
-ser.write("sp1" + chr(0x80))
-ser.write("sp2" + chr(0x80))
-ser.write("sp3" + chr(0x00))
-ser.write("sp4" + chr(0x00))
-
-ser.write("se1" + chr(0x80) + chr(0x05))
-ser.write("se2" + chr(0x00) + chr(0x00))
-ser.write("se3" + chr(0x00) + chr(0x00))
-ser.write("se4" + chr(0x00) + chr(0x00))
-
-ser.write("sA" + chr(0x05))
-
-ser.write("R")
+if os.environ.get('TASLINK_RECORD'):  # log everything that crosses the serial port, see recorder.py
+  ser = recorder.RecordingSerial(ser, os.environ['TASLINK_RECORD'])
+
+# the whole setup goes out in one write: lanes 1 and 3 take 8 bit frames with overread on ports 1 and 2 (with the
+# clock delay), one event on port 1 takes a frame from both, and custom stream 'A' fills them
+setup = [protocol.controllerSetup(lane, 8, overread=lane in (1, 3), connected=lane in (1, 3)) for lane in range(1, 9)]
+setup += [protocol.portSetup(port, protocol.SR_CONTROLLER, clockDelay=port <= 2) for port in range(1, 5)]
+setup += [protocol.eventSetup(1, protocol.laneMask([1, 3]))]
+setup += [protocol.eventSetup(port, 0, enabled=False) for port in range(2, 5)]
+setup += [protocol.streamSetup('A', protocol.laneMask([1, 3])), protocol.CLEAR_ALL]
+ser.write(''.join(setup))
 
   
 def send_frames1(amount):
   global framecount1
-  ser.write(''.join(buffer1[framecount1:(framecount1+amount)]));
+  ser.write(buffer1.getFrames(amount))
   framecount1 = framecount1 + amount
 
 
 send_frames1(prebuffer)
 
 while (1):
-  while (ser.inWaiting() == 0):
-    pass
-    
+  # blocks until the board sends something
   c = ser.read()
 
   if (c == 'f'):
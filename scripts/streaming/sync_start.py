@@ -0,0 +1,82 @@
+# Starts the consoles on several TASLink boards at the same moment, for races and multi-console showcases.
+#
+# Every board has its own TASLink.py running as a daemon (TASLink.py --daemon <socket> <interface> <runs...>). This
+# picks one monotonic time a little in the future and asks every daemon to start all its runs at it: each holds its
+# consoles in reset, prebuffers every run, and releases the consoles on time. The daemons have to be on this machine,
+# so they all read the same monotonic clock. Afterwards it reports how late each board released its consoles and when
+# each console first latched, and the skew between them.
+#
+# python sync_start.py <socket> [<socket> ...] [--in SECONDS] [--hold MS]
+
+import argparse
+import json
+import sys
+import threading
+
+import control
+from clock import monotonic
+
+CLOCK_TOLERANCE = 0.1  # seconds a daemon's clock can differ from ours before it's clearly not the same clock
+
+
+def startBoard(path, at, hold, results):
+    try:
+        response = control.request(path, "start all at %r hold %g" % (at, hold * 1000.0),
+                                   timeout=at - monotonic() + hold + 10.0)
+    except Exception as e:
+        results[path] = "err " + str(e)
+        return
+    results[path] = response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start the consoles on several TASLink boards at the same moment.")
+    parser.add_argument('sockets', nargs='+', help="control sockets of the TASLink.py daemons, one per board")
+    parser.add_argument('--in', dest='delay', type=float, default=2.0,
+                        help="seconds from now to start, leaves time to prebuffer (default 2)")
+    parser.add_argument('--hold', type=float, default=100.0, help="ms to hold the consoles in reset (default 100)")
+    args = parser.parse_args()
+
+    for path in args.sockets:
+        if not control.isSocket(path):
+            print("ERROR: " + path + " is not a control socket")
+            sys.exit(1)
+        response = control.request(path, "clock")
+        if not response.startswith("ok ") or abs(float(response[3:]) - monotonic()) > CLOCK_TOLERANCE:
+            print("ERROR: " + path + " doesn't share this machine's clock: " + response)
+            sys.exit(1)
+
+    hold = args.hold / 1000.0
+    at = monotonic() + max(args.delay, hold)
+    results = {}
+    threads = [threading.Thread(target=startBoard, args=(path, at, hold, results)) for path in args.sockets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    releases = []
+    latches = []
+    for path in args.sockets:
+        response = results.get(path, "err no response")
+        if not response.startswith("ok "):
+            print("%s: %s" % (path, response))
+            continue
+        report = json.loads(response[3:])
+        releases.append(report['released'])
+        print("%s: released %.3fms late (write %.3fms), held %.1fms" % (
+            path, report['late_ms'], report['write_ms'], report['held_ms']))
+        for run in sorted(report['first_latches'], key=int):
+            latchTime = report['first_latches'][run]
+            latches.append(latchTime)
+            print("  run #%s first latched %.3fms after the target" % (run, (latchTime - at) * 1e3))
+    if len(releases) > 1:
+        print("Skew between boards' releases: %.3fms" % ((max(releases) - min(releases)) * 1e3))
+    if latches:
+        print("Skew between consoles' first latches: %.3fms" % ((max(latches) - min(latches)) * 1e3))
+    else:
+        print("No console latched.")
+
+
+if __name__ == '__main__':
+    main()